@@ -1,16 +1,45 @@
 import os
+import re
+import json
+import time
+import gzip
+import zlib
+import struct
+import csv
+import base64
+import socket
+import fcntl
+import io
+import hashlib
+import threading
+import tempfile
+import zipfile
+import mimetypes
 import sqlite3
-from functools import wraps
+import pickle
+import atexit
+import urllib.request
+from bisect import bisect_left
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from functools import wraps, lru_cache
 from datetime import datetime
 
+import click
 from flask import (
     Flask, render_template, request, g, session, redirect,
-    url_for, flash, send_from_directory
+    url_for, flash, send_from_directory, send_file, abort, Response, stream_with_context
 )
+from flask.cli import AppGroup
+from markupsafe import Markup, escape
 from werkzeug.security import generate_password_hash, check_password_hash
-from werkzeug.utils import secure_filename
+from werkzeug.utils import secure_filename, safe_join
 
 import docx
+from docx.oxml.ns import qn
+from docx.table import Table
+from docx.text.paragraph import Paragraph
+from docx.text.run import Run
 import fitz  # PyMuPDF
 
 
@@ -18,50 +47,843 @@ app = Flask(__name__, template_folder='templates', static_folder='static')
 app.config['SECRET_KEY'] = 'a_very_secret_key_for_session_management_v11_final'
 app.config['DATABASE'] = os.path.join(app.instance_path, 'database.db')
 app.config['UPLOAD_FOLDER'] = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads')
+app.config['AUTO_MIGRATE'] = False  # True = tự áp dụng migration còn thiếu khi khởi động
+app.config['LIST_COUNT_TTL'] = 30  # giây; 0 = luôn đếm chính xác
+app.config['INGEST_ASYNC'] = True        # False = trích xuất ngay trong request (không cần worker)
+app.config['INGEST_MAX_ATTEMPTS'] = 3
+app.config['INGEST_RETRY_DELAY'] = 30    # giây, nhân với số lần đã thử
+app.config['INGEST_JOB_TIMEOUT'] = 600   # việc 'running' quá lâu được coi là worker đã chết
+app.config['EXTRACT_CHUNK_PAGES'] = 16   # số trang PDF mỗi phần việc trích xuất song song
+# Giao việc gửi tệp cho reverse proxy sau khi đã kiểm tra đăng nhập:
+# None | 'x-accel' (nginx, cần location internal trỏ tới UPLOAD_FOLDER) | 'x-sendfile' (Apache/lighttpd)
+app.config['UPLOAD_OFFLOAD'] = None
+app.config['UPLOAD_ACCEL_PREFIX'] = '/_protected_uploads/'
+app.config['RENDER_CACHE_DIR'] = os.path.join(app.instance_path, 'render_cache')
+app.config['RENDER_CACHE_MAX_BYTES'] = 512 * 1024 * 1024
+app.config['RENDER_JPEG_QUALITY'] = 75
+app.config['PREVIEW_CACHE_DIR'] = os.path.join(app.instance_path, 'preview_cache')
+app.config['PREVIEW_CACHE_MAX_BYTES'] = 128 * 1024 * 1024
+app.config['AVATAR_SIZES'] = (32, 64, 256)  # px, ảnh vuông
+app.config['AVATAR_JPEG_QUALITY'] = 85
+app.config['AVATAR_MAX_BYTES'] = 10 * 1024 * 1024
+app.config['AVATAR_MAX_PIXELS'] = 40_000_000
+# Bộ tóm tắt: 'local' (giả lập, 50 từ đầu) hoặc 'remote' (mô hình thật qua HTTP, xem RemoteSummarizer)
+app.config['SUMMARIZER'] = os.environ.get('SUMMARIZER', 'local')
+app.config['SUMMARIZER_URL'] = os.environ.get('SUMMARIZER_URL')
+app.config['SUMMARIZER_MODEL'] = os.environ.get('SUMMARIZER_MODEL', 'default')
+app.config['SUMMARIZER_API_KEY'] = os.environ.get('SUMMARIZER_API_KEY')
+app.config['SUMMARY_BATCH_SIZE'] = 8     # số văn bản mỗi lần gọi
+app.config['SUMMARY_CONCURRENCY'] = 4    # số lô gọi song song
+app.config['SUMMARY_TIMEOUT'] = 60       # giây cho mỗi lô
+app.config['SUMMARY_MAX_CHARS'] = 20000  # cắt văn bản đầu vào
+# Kết nối SQLite: mỗi luồng/tiến trình giữ một kết nối dùng lại qua các request.
+# WAL cho phép đọc song song với một người ghi; ghi mở giao dịch IMMEDIATE để chờ khóa theo
+# busy_timeout ngay từ đầu thay vì lỗi "database is locked" khi nâng khóa đọc lên ghi.
+app.config['SQLITE_PRAGMAS'] = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,           # ms
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -64 * 1024,       # số âm = KiB
+    'foreign_keys': 'ON',
+}
+app.config['SQLITE_ISOLATION_LEVEL'] = 'IMMEDIATE'
+app.config['SQLITE_CACHED_STATEMENTS'] = 256  # câu lệnh đã biên dịch giữ lại trên mỗi kết nối
+# Văn bản trang và tóm tắt dài được nén zlib khi ghi (xem pack_text); False = ghi nguyên văn, vẫn đọc được bản nén
+app.config['TEXT_COMPRESS'] = True
+app.config['TEXT_COMPRESS_MIN_BYTES'] = 512
+app.config['TEXT_COMPRESS_LEVEL'] = 6
+# Số liệu đo cho /metrics (định dạng Prometheus). Mỗi tiến trình ghi bản chụp vào METRICS_DIR, /metrics cộng dồn.
+app.config['METRICS'] = True
+app.config['METRICS_DIR'] = os.path.join(app.instance_path, 'metrics')
+app.config['METRICS_FLUSH_INTERVAL'] = 5  # giây
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')  # Prometheus gọi bằng Authorization: Bearer <token>
+app.config['METRICS_ALLOW_LOCALHOST'] = False  # True = cho 127.0.0.1/::1 xem không cần đăng nhập (không bật sau reverse proxy)
+app.config['METRICS_FILE_TTL'] = 24 * 3600  # giây; bản chụp không cập nhật lâu hơn thì bỏ (pid đã bị dùng lại…)
+app.config['SQL_SLOW_QUERY_MS'] = None    # ví dụ 100: ghi log câu SQL chậm kèm EXPLAIN QUERY PLAN
+# Cache kết quả trang Tài liệu/trình xem theo phiên bản dữ liệu: 'memory' (từng tiến trình), 'sqlite' (dùng chung
+# giữa các worker qua VIEW_CACHE_PATH) hoặc None để tắt
+app.config['VIEW_CACHE'] = 'memory'
+app.config['VIEW_CACHE_PATH'] = os.path.join(app.instance_path, 'view_cache.db')
+app.config['VIEW_CACHE_MAX_ENTRIES'] = 1024
+app.config['VIEW_CACHE_MAX_BYTES'] = 64 * 1024 * 1024
 os.makedirs(app.instance_path, exist_ok=True)
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
+# ---------- metrics ----------
+# Bộ đếm và histogram trong bộ nhớ từng tiến trình; định kỳ ghi ra METRICS_DIR/<pid>.json (ghi đè nguyên tử)
+# để /metrics cộng dồn được qua mọi worker. Tệp của tiến trình đã dừng được gộp vào METRICS_DIR/retired.json
+# rồi mới xóa, nên tổng không giảm khi worker thoát hay được thay mới.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+METRICS = {  # tên -> (kiểu, mô tả, nhãn, ngưỡng histogram)
+    'http_requests_total': ('counter', 'Số request theo endpoint, phương thức, mã trạng thái',
+                            ('endpoint', 'method', 'status'), None),
+    'http_request_duration_seconds': ('histogram', 'Thời gian xử lý request tới khi trả header',
+                                      ('endpoint', 'method'), LATENCY_BUCKETS),
+    'http_request_sql_queries': ('histogram', 'Số câu SQL mỗi request', ('endpoint',), (0, 1, 2, 5, 10, 20, 50, 100)),
+    'http_request_sql_seconds': ('histogram', 'Tổng thời gian SQL mỗi request', ('endpoint',), LATENCY_BUCKETS),
+    'sqlite_queries_total': ('counter', 'Số câu SQL đã chạy (cả ngoài request)', (), None),
+    'sqlite_query_seconds_total': ('counter', 'Tổng thời gian chạy SQL', (), None),
+    'sqlite_slow_queries_total': ('counter', 'Số câu SQL vượt SQL_SLOW_QUERY_MS', (), None),
+    'extract_files_total': ('counter', 'Số tệp được trích xuất văn bản', ('type',), None),
+    'extract_bytes_total': ('counter', 'Số byte tệp được trích xuất văn bản', ('type',), None),
+    'extract_duration_seconds': ('histogram', 'Thời gian trích xuất mỗi phần việc (PDF: một khoảng trang)',
+                                 ('type',), (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)),
+    'upload_bytes_total': ('counter', 'Số byte tệp tải lên', (), None),
+    'download_bytes_total': ('counter', 'Số byte tệp gửi qua /uploads (via=proxy: phần do reverse proxy gửi)',
+                             ('via',), None),
+    'view_cache_total': ('counter', 'Số lần tra cache trang theo kết quả (hit/miss)', ('view', 'result'), None),
+}
+_metrics = {'pid': None, 'data': {}, 'flushed': 0.0}
+_metrics_lock = threading.Lock()
+
+def _metrics_file(pid):
+    return os.path.join(app.config['METRICS_DIR'], f"{pid}.json")
+
+def _metrics_load(path):
+    try:
+        with open(path, encoding='utf-8') as fh:
+            return {(name, tuple(labels)): value for name, labels, value in json.load(fh)}
+    except (OSError, ValueError):
+        return {}
+
+def _metrics_data():
+    # gọi khi đang giữ khóa; sau fork tiến trình con bắt đầu từ số liệu của chính pid đó (nếu pid bị dùng lại)
+    pid = os.getpid()
+    if _metrics['pid'] != pid:
+        _metrics.update(pid=pid, data=_metrics_load(_metrics_file(pid)), flushed=time.monotonic())
+    return _metrics['data']
+
+def metric_inc(name, value=1, labels=()):
+    if not app.config['METRICS']: return
+    with _metrics_lock:
+        data = _metrics_data()
+        data[name, labels] = data.get((name, labels), 0) + value
+    metrics_flush()
+
+def metric_observe(name, value, labels=()):
+    if not app.config['METRICS']: return
+    buckets = METRICS[name][3]
+    with _metrics_lock:
+        data = _metrics_data()
+        h = data.get((name, labels)) or data.setdefault((name, labels), [0] * (len(buckets) + 2))
+        i = bisect_left(buckets, value)
+        if i < len(buckets): h[i] += 1  # lưu không cộng dồn; cộng dồn khi xuất
+        h[-2] += value; h[-1] += 1
+    metrics_flush()
+
+def metrics_flush(force=False):
+    if not force and time.monotonic() - _metrics['flushed'] < app.config['METRICS_FLUSH_INTERVAL']: return
+    with _metrics_lock:
+        if _metrics['pid'] != os.getpid(): return
+        _metrics['flushed'] = time.monotonic()
+        snapshot = [[name, list(labels), value] for (name, labels), value in _metrics['data'].items()]
+    try:
+        os.makedirs(app.config['METRICS_DIR'], exist_ok=True)
+        path = _metrics_file(os.getpid())
+        with open(path + '.tmp', 'w', encoding='utf-8') as fh: json.dump(snapshot, fh)
+        os.replace(path + '.tmp', path)
+    except OSError as e:
+        app.logger.warning("metrics: không ghi được %s", e)
+
+atexit.register(lambda: metrics_flush(force=True))
+
+def _pid_alive(pid):
+    try: os.kill(pid, 0)
+    except ProcessLookupError: return False
+    except (PermissionError, OSError): return True  # tồn tại nhưng không có quyền gửi tín hiệu
+    return True
+
+def _metrics_stale(path):
+    # bản chụp của worker đã thoát/bị thay thế không được cộng mãi vào mọi lần scrape
+    try: pid = int(os.path.basename(path)[:-len('.json')])
+    except ValueError: return True
+    try: age = time.time() - os.path.getmtime(path)
+    except OSError: return True
+    return not _pid_alive(pid) or age > app.config['METRICS_FILE_TTL']
+
+METRICS_RETIRED = 'retired.json'
+
+def _metrics_add(merged, key, value):
+    cur = merged.get(key)
+    if cur is None: merged[key] = list(value) if isinstance(value, list) else value
+    elif isinstance(cur, list):
+        if len(cur) == len(value): merged[key] = [a + b for a, b in zip(cur, value)]
+    else: merged[key] = cur + value
+
+def _metrics_retire(paths):
+    # khóa tệp: hai lần scrape đồng thời không gộp trùng/ghi đè retired.json của nhau
+    root = app.config['METRICS_DIR']
+    with open(os.path.join(root, '.lock'), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        retired_path = os.path.join(root, METRICS_RETIRED)
+        retired = _metrics_load(retired_path)
+        paths = [p for p in paths if os.path.exists(p)]  # lần scrape khác có thể đã gộp trong lúc chờ khóa
+        if not paths: return
+        for p in paths:
+            for key, value in _metrics_load(p).items(): _metrics_add(retired, key, value)
+        with open(retired_path + '.tmp', 'w', encoding='utf-8') as fh:
+            json.dump([[name, list(labels), value] for (name, labels), value in retired.items()], fh)
+        os.replace(retired_path + '.tmp', retired_path)
+        for p in paths: os.remove(p)
+
+def metrics_collect():
+    merged, root = {}, app.config['METRICS_DIR']
+    own = f"{os.getpid()}.json"
+    if os.path.isdir(root):
+        names = [fn for fn in os.listdir(root) if fn.endswith('.json') and fn not in (own, METRICS_RETIRED)]
+        stale = [os.path.join(root, fn) for fn in names if _metrics_stale(os.path.join(root, fn))]
+        if stale:
+            try: _metrics_retire(stale)
+            except OSError as e: app.logger.warning("metrics: không gộp được %s", e)
+        for fn in [METRICS_RETIRED] + names:
+            for key, value in _metrics_load(os.path.join(root, fn)).items(): _metrics_add(merged, key, value)
+    with _metrics_lock:
+        for key, value in _metrics_data().items(): _metrics_add(merged, key, value)
+    return merged
+
+def _label_str(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs: return ""
+    esc = lambda v: str(v).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in pairs) + "}"
+
+def metrics_text():
+    merged = metrics_collect()
+    out = []
+    for name, (kind, help_, labelnames, buckets) in METRICS.items():
+        out += [f"# HELP {name} {help_}", f"# TYPE {name} {kind}"]
+        for (n, labels), value in sorted((k, v) for k, v in merged.items() if k[0] == name):
+            if kind == 'counter':
+                out.append(f"{name}{_label_str(labelnames, labels)} {value}"); continue
+            acc = 0
+            for le, c in zip(buckets, value):
+                acc += c; out.append(f"{name}_bucket{_label_str(labelnames, labels, [('le', le)])} {acc}")
+            out.append(f"{name}_bucket{_label_str(labelnames, labels, [('le', '+Inf')])} {value[-1]}")
+            out.append(f"{name}_sum{_label_str(labelnames, labels)} {value[-2]}")
+            out.append(f"{name}_count{_label_str(labelnames, labels)} {value[-1]}")
+    return "\n".join(out) + "\n"
+
+@app.before_request
+def metrics_start():
+    if not app.config['METRICS']: return
+    g.metrics_t0 = time.perf_counter(); _local.req_sql = [0, 0.0]
+
+def metrics_record(status):
+    t0 = g.pop('metrics_t0', None)
+    if t0 is None: return
+    sql, _local.req_sql = getattr(_local, 'req_sql', None) or [0, 0.0], None
+    endpoint = request.endpoint or 'none'
+    metric_inc('http_requests_total', labels=(endpoint, request.method, str(status)))
+    metric_observe('http_request_duration_seconds', time.perf_counter() - t0, (endpoint, request.method))
+    metric_observe('http_request_sql_queries', sql[0], (endpoint,))
+    metric_observe('http_request_sql_seconds', sql[1], (endpoint,))
+
+@app.after_request
+def metrics_finish(resp):
+    metrics_record(resp.status_code)  # phản hồi dạng luồng (export) chỉ tính tới byte đầu tiên
+    return resp
+
+@app.teardown_request
+def metrics_teardown(e=None):
+    metrics_record(500)  # chỉ còn khi view ném lỗi (after_request không chạy)
+
+@app.route('/metrics')
+def metrics():
+    token = app.config['METRICS_TOKEN']
+    allowed = (session.get('user_role') == 'admin'
+               or (token and request.headers.get('Authorization') == f"Bearer {token}")
+               or (app.config['METRICS_ALLOW_LOCALHOST'] and request.remote_addr in ('127.0.0.1', '::1')))
+    if not allowed: abort(401 if token else 403)
+    return Response(metrics_text(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
 # ---------- DB helpers ----------
+_local = threading.local()
+
+class MeteredConnection(sqlite3.Connection):
+    # đếm số câu và thời gian chạy (bước đầu tiên: với SELECT có sắp xếp/gộp là phần lớn công việc)
+    def execute(self, sql, params=()):
+        t = time.perf_counter()
+        try: return super().execute(sql, params)
+        finally: sql_observed(self, sql, params, time.perf_counter() - t)
+
+    def executemany(self, sql, seq):
+        t = time.perf_counter()
+        try: return super().executemany(sql, seq)
+        finally: sql_observed(self, sql, None, time.perf_counter() - t)
+
+def sql_observed(db, sql, params, seconds):
+    req = getattr(_local, 'req_sql', None)
+    if req is not None: req[0] += 1; req[1] += seconds
+    metric_inc('sqlite_queries_total')
+    metric_inc('sqlite_query_seconds_total', seconds)
+    slow = app.config['SQL_SLOW_QUERY_MS']
+    if slow is None or seconds * 1000 < slow: return
+    metric_inc('sqlite_slow_queries_total')
+    plan = ""
+    if params is not None:
+        try:
+            rows = sqlite3.Connection.execute(db, "EXPLAIN QUERY PLAN " + sql, params).fetchall()
+            depth = {0: 0}
+            for r in rows: depth[r[0]] = depth.get(r[1], 0) + 1
+            plan = "".join(f"\n  {'  ' * (depth[r[0]] - 1)}{r[3]}" for r in rows)
+        except sqlite3.Error:
+            pass
+    app.logger.warning("sql chậm %.1f ms: %s%s", seconds * 1000, " ".join(sql.split()), plan)
+
+# Nén văn bản lưu trong CSDL: giá trị nén là BLOB mở đầu bằng một byte định dạng (b'z' = zlib), giá trị TEXT cũ
+# đọc được như trước. SQL đọc qua hàm unz() (view nguồn FTS, tìm trong trang…) nên mọi kết nối ghi vào
+# documents/document_contents đều phải đăng ký hàm này (register_sql_functions), kể cả script ngoài app.
+TEXT_ZLIB = b'z'
+
+def pack_text(s):
+    if not s or not app.config['TEXT_COMPRESS'] or len(s) < app.config['TEXT_COMPRESS_MIN_BYTES']: return s
+    raw = s.encode('utf-8')
+    packed = TEXT_ZLIB + zlib.compress(raw, app.config['TEXT_COMPRESS_LEVEL'])
+    return packed if len(packed) < len(raw) else s
+
+def unpack_text(v):
+    if isinstance(v, bytes) and v[:1] == TEXT_ZLIB: return zlib.decompress(v[1:]).decode('utf-8')
+    return v
+
+def register_sql_functions(db):
+    db.create_function('unz', 1, unpack_text, deterministic=True)
+
+def connect_db(path=None):
+    db = sqlite3.connect(path or app.config['DATABASE'], detect_types=sqlite3.PARSE_DECLTYPES,
+                         isolation_level=app.config['SQLITE_ISOLATION_LEVEL'],
+                         cached_statements=app.config['SQLITE_CACHED_STATEMENTS'], factory=MeteredConnection)
+    db.row_factory = sqlite3.Row
+    register_sql_functions(db)
+    for name, value in app.config['SQLITE_PRAGMAS'].items():
+        db.execute(f"PRAGMA {name} = {value}")
+    return db
+
 def get_db():
     if 'db' not in g:
-        g.db = sqlite3.connect(app.config['DATABASE'], detect_types=sqlite3.PARSE_DECLTYPES)
-        g.db.row_factory = sqlite3.Row
+        # kết nối của luồng hiện tại; tạo lại sau fork hoặc khi DATABASE đổi (test)
+        key = (os.getpid(), app.config['DATABASE'])
+        if getattr(_local, 'key', None) != key:
+            _local.db, _local.key = connect_db(), key
+        g.db = _local.db
     return g.db
 
 @app.teardown_appcontext
 def close_db(e=None):
+    # không đóng: chỉ hủy giao dịch dở dang để request sau nhận kết nối sạch
     db = g.pop('db', None)
-    if db is not None:
-        db.close()
+    if db is not None and db.in_transaction:
+        db.rollback()
 
-def ensure_schema():
-    db = get_db()
-    # documents extra cols
-    dcols = [r[1] for r in db.execute("PRAGMA table_info(documents)").fetchall()]
-    changed = False
+# ---------- migrations ----------
+# Mỗi migration có một số thứ tự; phiên bản đã áp dụng lưu trong PRAGMA user_version.
+# schema.sql là lược đồ gốc (phiên bản 0), mọi thay đổi sau đó phải đi qua đây.
+MIGRATIONS = {}
+
+def migration(version):
+    def deco(fn):
+        MIGRATIONS[version] = fn
+        return fn
+    return deco
+
+def _columns(db, table):
+    return [r[1] for r in db.execute(f"PRAGMA table_xinfo({table})").fetchall()]
+
+@migration(1)
+def _m001_documents_extra_cols(db):
+    dcols = _columns(db, 'documents')
     for col, ddl in [
         ('week_number',  "ALTER TABLE documents ADD COLUMN week_number INTEGER"),
         ('year_number',  "ALTER TABLE documents ADD COLUMN year_number INTEGER"),
         ('notes',        "ALTER TABLE documents ADD COLUMN notes TEXT"),
     ]:
-        if col not in dcols:
-            db.execute(ddl); changed = True
+        if col not in dcols: db.execute(ddl)
 
-    # users avatar
-    ucols = [r[1] for r in db.execute("PRAGMA table_info(users)").fetchall()]
-    if 'avatar' not in ucols:
+@migration(2)
+def _m002_users_avatar(db):
+    if 'avatar' not in _columns(db, 'users'):
         db.execute("ALTER TABLE users ADD COLUMN avatar TEXT")
-        changed = True
 
-    if changed: db.commit()
+# Tìm kiếm toàn văn: bảng FTS5 external-content đọc từ view documents_fts_src.
+# unicode61 + remove_diacritics 2 bỏ dấu thanh/dấu mũ; riêng "đ" không tách dấu được
+# nên view đổi đ -> d trước khi lập chỉ mục (truy vấn cũng được đổi tương tự).
+FTS_COLUMNS = ('title', 'authoring_agency', 'original_text', 'translated_text',
+               'main_content_summary', 'notes')
+FTS_WEIGHTS = (10.0, 4.0, 1.0, 1.0, 2.0, 1.0)
+
+def _fold_sql(expr): return f"replace(replace({expr}, 'đ', 'd'), 'Đ', 'D')"
+
+def _fts_source_view(db, sources, from_sql):
+    # sources: {cột FTS: biểu thức SQL lấy giá trị gốc}
+    db.execute("DROP VIEW IF EXISTS documents_fts_src")
+    db.execute(f"""
+        CREATE VIEW documents_fts_src AS
+        SELECT d.id, {", ".join(f"{_fold_sql(sources[c])} AS {c}" for c in FTS_COLUMNS)}
+        {from_sql}
+    """)
+
+def _fts_triggers(db, table, key, watched):
+    # xóa bản ghi chỉ mục cũ TRƯỚC khi ghi, chèn lại SAU khi ghi; view luôn phản ánh trạng thái hiện tại
+    cols = ", ".join(FTS_COLUMNS)
+    fts_insert = f"INSERT INTO documents_fts(rowid, {cols}) SELECT id, {cols} FROM documents_fts_src"
+    fts_delete = f"INSERT INTO documents_fts(documents_fts, rowid, {cols}) SELECT 'delete', id, {cols} FROM documents_fts_src"
+    for event, of, before_ref, after_ref in [
+        ('INSERT', '', 'new', 'new'),
+        ('UPDATE', f" OF {', '.join(watched)}", 'old', 'new'),
+        ('DELETE', '', 'old', 'old'),
+    ]:
+        for when, body, ref in (('BEFORE', fts_delete, before_ref), ('AFTER', fts_insert, after_ref)):
+            name = f"{table}_fts_{when[0].lower()}{event[0].lower()}"
+            db.execute(f"DROP TRIGGER IF EXISTS {name}")
+            db.execute(f"CREATE TRIGGER {name} {when} {event}{of} ON {table} "
+                       f"BEGIN {body} WHERE id = {ref}.{key}; END")
+
+@migration(3)
+def _m003_documents_fts(db):
+    _fts_source_view(db, {c: f"d.{c}" for c in FTS_COLUMNS}, "FROM documents d")
+    db.execute(f"""
+        CREATE VIRTUAL TABLE IF NOT EXISTS documents_fts USING fts5(
+            {", ".join(FTS_COLUMNS)}, content='documents_fts_src', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+    """)
+    _fts_triggers(db, 'documents', 'id', FTS_COLUMNS)
+    db.execute("INSERT INTO documents_fts(documents_fts) VALUES('rebuild')")
+
+# Văn bản lớn tách sang bảng riêng để truy vấn danh sách không phải đọc chúng.
+# main_content_summary đứng đầu: đọc cột này không phải đi qua các trang tràn của văn bản gốc.
+CONTENT_COLUMNS = ('main_content_summary', 'original_text', 'translated_text')
+
+@migration(4)
+def _m004_document_contents(db):
+    for r in db.execute("SELECT name FROM sqlite_master WHERE type='trigger' AND name LIKE 'documents_fts_%'").fetchall():
+        db.execute(f"DROP TRIGGER {r[0]}")
+    db.execute("DROP VIEW IF EXISTS documents_fts_src")
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS document_contents (
+            document_id INTEGER PRIMARY KEY REFERENCES documents (id) ON DELETE CASCADE,
+            main_content_summary TEXT,
+            original_text TEXT,
+            translated_text TEXT
+        )
+    """)
+    if 'original_text' in _columns(db, 'documents'):
+        db.execute("""
+            INSERT OR REPLACE INTO document_contents (document_id, main_content_summary, original_text, translated_text)
+            SELECT id, main_content_summary, original_text, translated_text FROM documents
+        """)
+        for col in CONTENT_COLUMNS:
+            db.execute(f"ALTER TABLE documents DROP COLUMN {col}")
+    db.execute("""
+        CREATE TRIGGER IF NOT EXISTS documents_contents_ad AFTER DELETE ON documents
+        BEGIN DELETE FROM document_contents WHERE document_id = old.id; END
+    """)
+    _fts_source_view(db, {c: (f"c.{c}" if c in CONTENT_COLUMNS else f"d.{c}") for c in FTS_COLUMNS},
+                     "FROM documents d LEFT JOIN document_contents c ON c.document_id = d.id")
+    _fts_triggers(db, 'documents', 'id', [c for c in FTS_COLUMNS if c not in CONTENT_COLUMNS])
+    _fts_triggers(db, 'document_contents', 'document_id', CONTENT_COLUMNS)
+
+@migration(5)
+def _m005_documents_created_index(db):
+    db.execute("CREATE INDEX IF NOT EXISTS idx_documents_created_id ON documents (created_at, id)")
+
+@migration(6)
+def _m006_filter_columns_and_indexes(db):
+    # tuần/năm suy ra từ creation_date (cột sinh ảo, luôn nhất quán) thay cho strftime() trong WHERE
+    cols = _columns(db, 'documents')
+    if 'creation_year' not in cols:
+        db.execute("""ALTER TABLE documents ADD COLUMN creation_year INTEGER
+                      GENERATED ALWAYS AS (CAST(strftime('%Y', creation_date) AS INTEGER)) VIRTUAL""")
+    if 'creation_week' not in cols:
+        db.execute("""ALTER TABLE documents ADD COLUMN creation_week INTEGER
+                      GENERATED ALWAYS AS (CAST(strftime('%W', creation_date) AS INTEGER)) VIRTUAL""")
+    for ddl in [
+        "CREATE INDEX IF NOT EXISTS idx_documents_status_created ON documents (status, created_at, id)",
+        "CREATE INDEX IF NOT EXISTS idx_documents_handler_created ON documents (handler_id, created_at, id)",
+        "CREATE INDEX IF NOT EXISTS idx_documents_country_created ON documents (country COLLATE NOCASE, created_at, id)",
+        "CREATE INDEX IF NOT EXISTS idx_documents_year_created ON documents (creation_year, created_at, id)",
+        "CREATE INDEX IF NOT EXISTS idx_documents_year_week_created ON documents (creation_year, creation_week, created_at, id)",
+    ]:
+        db.execute(ddl)
+    db.execute("ANALYZE documents")
+
+# Thẻ thống kê trên dashboard: một dòng duy nhất, được trigger cập nhật khi thêm/xóa/đổi trạng thái.
+STAT_STATUSES = (('unassigned', 'Chưa xử lý'), ('processing', 'Đang xử lý'), ('completed', 'Đã xử lý'))
+
+def recount_stats(db):
+    db.execute(f"""
+        INSERT OR REPLACE INTO document_stats (id, total, {", ".join(k for k, _ in STAT_STATUSES)})
+        SELECT 1, COUNT(*), {", ".join(f"COALESCE(SUM(status = '{v}'), 0)" for _, v in STAT_STATUSES)}
+        FROM documents
+    """)
+
+@migration(7)
+def _m007_document_stats(db):
+    db.execute(f"""
+        CREATE TABLE IF NOT EXISTS document_stats (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            total INTEGER NOT NULL DEFAULT 0,
+            {", ".join(f"{k} INTEGER NOT NULL DEFAULT 0" for k, _ in STAT_STATUSES)}
+        )
+    """)
+    def delta(ref, sign):
+        return ", ".join([f"total = total {sign} 1"] +
+                         [f"{k} = {k} {sign} ({ref}.status = '{v}')" for k, v in STAT_STATUSES])
+    moves = ", ".join(f"{k} = {k} - (old.status = '{v}') + (new.status = '{v}')" for k, v in STAT_STATUSES)
+    for name, when, body in [
+        ('documents_stats_ai', "AFTER INSERT ON documents", delta('new', '+')),
+        ('documents_stats_ad', "AFTER DELETE ON documents", delta('old', '-')),
+        ('documents_stats_au', "AFTER UPDATE OF status ON documents", moves),
+    ]:
+        db.execute(f"DROP TRIGGER IF EXISTS {name}")
+        db.execute(f"CREATE TRIGGER {name} {when} BEGIN UPDATE document_stats SET {body} WHERE id = 1; END")
+    recount_stats(db)
+
+@migration(8)
+def _m008_ingest_jobs(db):
+    if 'ingest_status' not in _columns(db, 'documents'):
+        db.execute("ALTER TABLE documents ADD COLUMN ingest_status TEXT NOT NULL DEFAULT 'ready'")
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS ingest_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            document_id INTEGER NOT NULL REFERENCES documents (id) ON DELETE CASCADE,
+            status TEXT NOT NULL DEFAULT 'pending',  -- pending | running | done | error
+            summarize INTEGER NOT NULL DEFAULT 0,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            max_attempts INTEGER NOT NULL DEFAULT 3,
+            run_after REAL NOT NULL DEFAULT 0,
+            locked_by TEXT,
+            locked_at REAL,
+            error TEXT,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    db.execute("CREATE INDEX IF NOT EXISTS idx_ingest_jobs_status ON ingest_jobs (status, run_after)")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_ingest_jobs_document ON ingest_jobs (document_id)")
+    db.execute("""
+        CREATE TRIGGER IF NOT EXISTS documents_ingest_jobs_ad AFTER DELETE ON documents
+        BEGIN DELETE FROM ingest_jobs WHERE document_id = old.id; END
+    """)
+
+PAGE_KINDS = ('original', 'translated')
+
+@migration(9)
+def _m009_document_pages(db):
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS document_pages (
+            id INTEGER PRIMARY KEY,
+            document_id INTEGER NOT NULL REFERENCES documents (id) ON DELETE CASCADE,
+            kind TEXT NOT NULL,  -- original | translated
+            page_no INTEGER NOT NULL,
+            text TEXT,
+            UNIQUE (document_id, kind, page_no)
+        )
+    """)
+    db.execute("""
+        CREATE TRIGGER IF NOT EXISTS documents_pages_ad AFTER DELETE ON documents
+        BEGIN DELETE FROM document_pages WHERE document_id = old.id; END
+    """)
+    for r in db.execute("""SELECT name FROM sqlite_master WHERE type='trigger'
+                           AND (name LIKE 'documents_fts_%' OR name LIKE 'document_contents_fts_%')""").fetchall():
+        db.execute(f"DROP TRIGGER {r[0]}")
+    db.execute("DROP VIEW IF EXISTS documents_fts_src")
+    # văn bản cũ không chia trang -> chuyển thành trang 1
+    ccols = _columns(db, 'document_contents')
+    for kind in PAGE_KINDS:
+        if f"{kind}_text" not in ccols: continue
+        db.execute(f"""
+            INSERT OR REPLACE INTO document_pages (document_id, kind, page_no, text)
+            SELECT document_id, '{kind}', 1, {kind}_text FROM document_contents
+            WHERE {kind}_text IS NOT NULL AND {kind}_text <> ''
+        """)
+        db.execute(f"ALTER TABLE document_contents DROP COLUMN {kind}_text")
+    pages = {kind: f"""CASE WHEN d.ingest_status = 'ready' THEN (
+                SELECT group_concat(text, '') FROM (
+                    SELECT text FROM document_pages p
+                    WHERE p.document_id = d.id AND p.kind = '{kind}' ORDER BY p.page_no)) END"""
+             for kind in PAGE_KINDS}
+    _fts_source_view(db, {'title': 'd.title', 'authoring_agency': 'd.authoring_agency',
+                          'original_text': pages['original'], 'translated_text': pages['translated'],
+                          'main_content_summary': 'c.main_content_summary', 'notes': 'd.notes'},
+                     "FROM documents d LEFT JOIN document_contents c ON c.document_id = d.id")
+    _fts_triggers(db, 'documents', 'id', ['title', 'authoring_agency', 'notes', 'ingest_status'])
+    _fts_triggers(db, 'document_contents', 'document_id', ['main_content_summary'])
+    db.execute("INSERT INTO documents_fts(documents_fts) VALUES('rebuild')")
+
+@migration(10)
+def _m010_blobs(db):
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS blobs (
+            hash TEXT PRIMARY KEY,
+            path TEXT NOT NULL UNIQUE,  -- tương đối so với UPLOAD_FOLDER
+            size INTEGER NOT NULL,
+            refcount INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    cols = _columns(db, 'documents')
+    for kind in PAGE_KINDS:
+        if f"{kind}_file_name" not in cols:
+            db.execute(f"ALTER TABLE documents ADD COLUMN {kind}_file_name TEXT")
+            rows = db.execute(f"SELECT id, {kind}_file_path FROM documents WHERE {kind}_file_path IS NOT NULL").fetchall()
+            db.executemany(f"UPDATE documents SET {kind}_file_name=? WHERE id=?",
+                           [(os.path.basename(r[1].replace('\\', '/')), r[0]) for r in rows])
+        db.execute(f"CREATE INDEX IF NOT EXISTS idx_documents_{kind}_file ON documents ({kind}_file_path)")
+    def ref(row, sign):
+        return " ".join(f"UPDATE blobs SET refcount = refcount {sign} 1 WHERE path = {row}.{k}_file_path;"
+                        for k in PAGE_KINDS)
+    for name, when, body in [
+        ('documents_blobs_ai', "AFTER INSERT ON documents", ref('new', '+')),
+        ('documents_blobs_ad', "AFTER DELETE ON documents", ref('old', '-')),
+        ('documents_blobs_au', "AFTER UPDATE OF original_file_path, translated_file_path ON documents",
+         ref('old', '-') + " " + ref('new', '+')),
+    ]:
+        db.execute(f"DROP TRIGGER IF EXISTS {name}")
+        db.execute(f"CREATE TRIGGER {name} {when} BEGIN {body} END")
+
+@migration(11)
+def _m011_summary_queue(db):
+    cols = _columns(db, 'document_contents')
+    for col, ddl in [
+        ('summary_status',    "TEXT NOT NULL DEFAULT 'ready'"),  # ready | pending | running | error
+        ('summary_attempts',  "INTEGER NOT NULL DEFAULT 0"),
+        ('summary_run_after', "REAL NOT NULL DEFAULT 0"),        # pending: thử lại sau; running: hết hạn nhận việc
+        ('summary_error',     "TEXT"),
+    ]:
+        if col not in cols: db.execute(f"ALTER TABLE document_contents ADD COLUMN {col} {ddl}")
+    db.execute("""
+        CREATE INDEX IF NOT EXISTS idx_document_contents_summary
+        ON document_contents (summary_status, summary_run_after)
+    """)
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS summary_cache (
+            key TEXT PRIMARY KEY,  -- sha256(bộ tóm tắt + văn bản đầu vào)
+            summarizer TEXT NOT NULL,
+            summary TEXT NOT NULL,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+@migration(12)
+def _m012_data_versions(db):
+    # bộ đếm phiên bản dữ liệu cho cache trong bộ nhớ của các tiến trình
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS data_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    db.execute("INSERT OR IGNORE INTO data_versions (name, version) VALUES ('users', 0)")
+    for name, when in [('users_version_ai', "AFTER INSERT ON users"),
+                       ('users_version_au', "AFTER UPDATE ON users"),
+                       ('users_version_ad', "AFTER DELETE ON users")]:
+        db.execute(f"DROP TRIGGER IF EXISTS {name}")
+        db.execute(f"CREATE TRIGGER {name} {when} BEGIN "
+                   f"UPDATE data_versions SET version = version + 1 WHERE name = 'users'; END")
+
+@migration(13)
+def _m013_canonical_timestamps(db):
+    # CAST: đọc chuỗi gốc, tránh bộ chuyển đổi TIMESTAMP của sqlite3 vỡ với định dạng lạ
+    rows = db.execute("""
+        SELECT id, creation_date, completion_time, CAST(created_at AS TEXT) FROM documents
+    """).fetchall()
+    fixed = []
+    for doc_id, *vals in rows:
+        new = [canonical_dt(v) for v in vals]
+        if new != list(vals): fixed.append((*new, doc_id))
+    db.executemany("UPDATE documents SET creation_date=?, completion_time=?, created_at=? WHERE id=?", fixed)
+
+@migration(14)
+def _m014_import_log(db):
+    # dòng manifest đã nhập (ghi cùng giao dịch với tài liệu) -> `flask import-docs` chạy lại để tiếp tục
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS import_log (
+            source_key TEXT PRIMARY KEY,
+            document_id INTEGER NOT NULL REFERENCES documents (id) ON DELETE CASCADE,
+            imported_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    db.execute("CREATE INDEX IF NOT EXISTS idx_import_log_document ON import_log (document_id)")
+    db.execute("""
+        CREATE TRIGGER IF NOT EXISTS documents_import_log_ad AFTER DELETE ON documents
+        BEGIN DELETE FROM import_log WHERE document_id = old.id; END
+    """)
+
+@migration(15)
+def _m015_row_versions(db):
+    # phiên bản dòng cho ETag/If-Match của API và chống ghi đè khi sửa đồng thời
+    for table in ('documents', 'users'):
+        if 'row_version' not in _columns(db, table):
+            db.execute(f"ALTER TABLE {table} ADD COLUMN row_version INTEGER NOT NULL DEFAULT 1")
+        # WHEN: câu UPDATE đã tự tăng row_version (sửa có điều kiện) thì không tăng thêm
+        db.execute(f"DROP TRIGGER IF EXISTS {table}_row_version_au")
+        db.execute(f"""
+            CREATE TRIGGER {table}_row_version_au AFTER UPDATE ON {table}
+            WHEN new.row_version = old.row_version
+            BEGIN UPDATE {table} SET row_version = old.row_version + 1 WHERE id = new.id; END
+        """)
+    db.execute("DROP TRIGGER IF EXISTS document_contents_row_version_au")
+    db.execute("""
+        CREATE TRIGGER document_contents_row_version_au
+        AFTER UPDATE OF main_content_summary, summary_status ON document_contents
+        BEGIN UPDATE documents SET row_version = row_version + 1 WHERE id = new.document_id; END
+    """)
+
+@migration(16)
+def _m016_documents_data_version(db):
+    # phiên bản toàn cục của dữ liệu tài liệu cho cache trang (mọi đường ghi: web, API, worker, import-docs)
+    db.execute("INSERT OR IGNORE INTO data_versions (name, version) VALUES ('documents', 0)")
+    for table in ('documents', 'document_contents'):
+        for suffix, event in (('ai', 'INSERT'), ('au', 'UPDATE'), ('ad', 'DELETE')):
+            db.execute(f"DROP TRIGGER IF EXISTS {table}_version_{suffix}")
+            db.execute(f"CREATE TRIGGER {table}_version_{suffix} AFTER {event} ON {table} BEGIN "
+                       f"UPDATE data_versions SET version = version + 1 WHERE name = 'documents'; END")
+
+@migration(17)
+def _m017_compressed_text(db):
+    # view nguồn FTS giải nén văn bản trang/tóm tắt; nội dung lập chỉ mục không đổi nên không cần rebuild
+    for r in db.execute("""SELECT name FROM sqlite_master WHERE type='trigger'
+                           AND (name LIKE 'documents_fts_%' OR name LIKE 'document_contents_fts_%')""").fetchall():
+        db.execute(f"DROP TRIGGER {r[0]}")
+    pages = {kind: f"""CASE WHEN d.ingest_status = 'ready' THEN (
+                SELECT group_concat(unz(text), '') FROM (
+                    SELECT text FROM document_pages p
+                    WHERE p.document_id = d.id AND p.kind = '{kind}' ORDER BY p.page_no)) END"""
+             for kind in PAGE_KINDS}
+    _fts_source_view(db, {'title': 'd.title', 'authoring_agency': 'd.authoring_agency',
+                          'original_text': pages['original'], 'translated_text': pages['translated'],
+                          'main_content_summary': 'unz(c.main_content_summary)', 'notes': 'd.notes'},
+                     "FROM documents d LEFT JOIN document_contents c ON c.document_id = d.id")
+    _fts_triggers(db, 'documents', 'id', ['title', 'authoring_agency', 'notes', 'ingest_status'])
+    _fts_triggers(db, 'document_contents', 'document_id', ['main_content_summary'])
+    report = compress_stored_text(db)
+    before, after = sum(r[1] for r in report.values()), sum(r[2] for r in report.values())
+    if before:
+        app.logger.info("Đã nén văn bản: %.1f MB -> %.1f MB (chạy VACUUM để thu hồi dung lượng tệp)",
+                        before / 1e6, after / 1e6)
+
+# Bảng gộp cho số đếm bộ lọc (facet): một dòng cho mỗi tổ hợp trạng thái/hướng/người xử lý/năm (không theo tuần:
+# số tổ hợp sẽ gần bằng số tài liệu), trigger cập nhật như document_stats. NULL lưu thành '' / 0 để làm khóa chính.
+FACET_KEYS = (("status", "''"), ("country", "''"), ("handler_id", "0"), ("creation_year", "0"))
+
+def recount_facets(db):
+    cols = ", ".join(k for k, _ in FACET_KEYS)
+    db.execute("DELETE FROM document_facets")
+    db.execute(f"""
+        INSERT INTO document_facets ({cols}, n)
+        SELECT {", ".join(f"IFNULL({k}, {null})" for k, null in FACET_KEYS)}, COUNT(*) FROM documents
+        GROUP BY {", ".join(f"IFNULL({k}, {null})" + (" COLLATE NOCASE" if k == 'country' else "") for k, null in FACET_KEYS)}
+    """)
+
+@migration(18)
+def _m018_document_facets(db):
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS document_facets (
+            status TEXT NOT NULL,
+            country TEXT NOT NULL COLLATE NOCASE,
+            handler_id INTEGER NOT NULL,
+            creation_year INTEGER NOT NULL,
+            n INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (status, country, handler_id, creation_year)
+        ) WITHOUT ROWID
+    """)
+    cols = ", ".join(k for k, _ in FACET_KEYS)
+    def add(ref):
+        return (f"INSERT INTO document_facets ({cols}, n) VALUES "
+                f"({', '.join(f'IFNULL({ref}.{k}, {null})' for k, null in FACET_KEYS)}, 1) "
+                f"ON CONFLICT DO UPDATE SET n = n + 1;")
+    def remove(ref):
+        key = " AND ".join(f"{k} = IFNULL({ref}.{k}, {null})" for k, null in FACET_KEYS)
+        return (f"UPDATE document_facets SET n = n - 1 WHERE {key}; "
+                f"DELETE FROM document_facets WHERE {key} AND n <= 0;")
+    changed = " OR ".join(f"old.{k} IS NOT new.{k}" for k, _ in FACET_KEYS)
+    for name, when, body in [
+        ('documents_facets_ai', "AFTER INSERT ON documents", add('new')),
+        ('documents_facets_ad', "AFTER DELETE ON documents", remove('old')),
+        ('documents_facets_au', f"AFTER UPDATE OF status, country, handler_id, creation_date ON documents WHEN {changed}",
+         remove('old') + " " + add('new')),
+    ]:
+        db.execute(f"DROP TRIGGER IF EXISTS {name}")
+        db.execute(f"CREATE TRIGGER {name} {when} BEGIN {body} END")
+    recount_facets(db)
+
+# Đoạn đầu tóm tắt (chưa nén) cho danh sách: trang Tài liệu không phải giải nén tóm tắt của từng dòng.
+# Trigger ghi lại cột này cùng câu lệnh ghi main_content_summary, nên mọi đường ghi (web, API, worker, import) đều đúng.
+SUMMARY_PREVIEW_CHARS = 200
+
+@migration(19)
+def _m019_summary_preview(db):
+    if 'summary_preview' not in _columns(db, 'document_contents'):
+        db.execute("ALTER TABLE document_contents ADD COLUMN summary_preview TEXT")
+    preview = f"substr(unz(new.main_content_summary), 1, {SUMMARY_PREVIEW_CHARS})"
+    for name, event in (('document_contents_preview_ai', "AFTER INSERT ON document_contents"),
+                        ('document_contents_preview_au', "AFTER UPDATE OF main_content_summary ON document_contents")):
+        db.execute(f"DROP TRIGGER IF EXISTS {name}")
+        db.execute(f"CREATE TRIGGER {name} {event} BEGIN UPDATE document_contents SET summary_preview = {preview} "
+                   f"WHERE document_id = new.document_id; END")
+    db.execute(f"UPDATE document_contents SET summary_preview = substr(unz(main_content_summary), 1, {SUMMARY_PREVIEW_CHARS}) "
+               "WHERE main_content_summary IS NOT NULL")
+
+def latest_version(): return max(MIGRATIONS) if MIGRATIONS else 0
+
+def schema_version(db): return db.execute("PRAGMA user_version").fetchone()[0]
+
+def upgrade_db(db, target=None):
+    target = latest_version() if target is None else target
+    applied = []
+    for version in sorted(MIGRATIONS):
+        if version <= schema_version(db) or version > target: continue
+        # giữ khóa ghi rồi đọc lại phiên bản: hai tiến trình khởi động cùng lúc không áp dụng trùng một migration
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            if version <= schema_version(db):
+                db.rollback(); continue
+            MIGRATIONS[version](db)
+            db.execute(f"PRAGMA user_version = {int(version)}")
+            db.commit()
+        except Exception:
+            db.rollback(); raise
+        applied.append(version)
+    return applied
+
+def check_schema_at_startup():
+    # gọi khi khởi động web/worker (không chạy lúc import, không chạy với nhóm lệnh `flask db`)
+    path = app.config['DATABASE']
+    if not os.path.exists(path): return
+    db = connect_db(path)
+    try:
+        if not db.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='documents'").fetchone():
+            return
+        current = schema_version(db)
+        if current >= latest_version(): return
+        if app.config['AUTO_MIGRATE']:
+            applied = upgrade_db(db)
+            app.logger.info("Đã nâng cấp CSDL: migration %s", applied)
+        else:
+            raise RuntimeError(f"CSDL đang ở phiên bản {current}, cần {latest_version()}. Chạy `flask db upgrade`.")
+    finally:
+        db.close()
+
+_schema_checked = False
+_schema_lock = threading.Lock()
 
 @app.before_request
-def _ensure_schema_on_every_request():
-    ensure_schema()
+def ensure_schema():
+    # kiểm tra một lần mỗi tiến trình web; lỗi -> 503 cho tới khi nâng cấp xong (không cần khởi động lại)
+    global _schema_checked
+    if _schema_checked: return
+    with _schema_lock:
+        if _schema_checked: return
+        try: check_schema_at_startup()
+        except RuntimeError as e:
+            app.logger.error("%s", e); abort(503)
+        _schema_checked = True
 
 # ---------- time filters ----------
-def _parse_dt(s):
-    if not s: return None
+# Thời gian lưu theo một dạng chuẩn: 'YYYY-MM-DD HH:MM:SS' (UTC với created_at/report), hoặc 'YYYY-MM-DD'
+# khi chỉ có ngày. Dạng này so sánh/sắp xếp đúng theo thứ tự chuỗi nên truy vấn khoảng ngày dùng được chỉ mục.
+def _parse_loose(s):
+    # dữ liệu cũ / nhập tay: nhiều định dạng
     s = str(s).strip().replace('T', ' ').replace('Z', '')
     for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"):
         try: return datetime.strptime(s, fmt)
@@ -69,22 +891,41 @@ def _parse_dt(s):
     try: return datetime.fromisoformat(s)
     except Exception: return None
 
-@app.template_filter('vn_date')
-def vn_date(s):
+def _parse_dt(s):
+    if not s: return None
+    if isinstance(s, datetime): return s
+    try: return datetime.fromisoformat(s)  # dạng chuẩn: một lần gọi C
+    except (TypeError, ValueError): return _parse_loose(s)
+
+def canonical_dt(s):
+    if not s: return None
+    if isinstance(s, datetime): return s.strftime("%Y-%m-%d %H:%M:%S")
+    dt = _parse_loose(s)
+    if not dt: return str(s).strip()  # không đọc được -> giữ nguyên
+    has_time = bool(re.search(r"\d[T ]\d", str(s)))
+    return dt.strftime("%Y-%m-%d %H:%M:%S") if has_time else dt.strftime("%Y-%m-%d")
+
+def now_ts():
+    return datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+
+# mỗi trang danh sách định dạng lại cùng một tập giá trị -> nhớ kết quả theo (giá trị, kiểu)
+@lru_cache(maxsize=8192)
+def _format_dt(s, kind):
     dt = _parse_dt(s)
     if not dt: return s or ""
-    has_time = not (dt.hour == 0 and dt.minute == 0 and dt.second == 0 and (" " not in str(s)))
-    return dt.strftime("%d/%m/%Y %H:%M") if has_time else dt.strftime("%d/%m/%Y")
+    if kind == 'vn':
+        has_time = not (dt.hour == 0 and dt.minute == 0 and dt.second == 0 and (" " not in str(s)))
+        return dt.strftime("%d/%m/%Y %H:%M") if has_time else dt.strftime("%d/%m/%Y")
+    return dt.strftime("%Y-%m-%d %H:%M" if kind == 'ymd_hm' else "%Y-%m-%d")
+
+@app.template_filter('vn_date')
+def vn_date(s): return _format_dt(s, 'vn')
 
 @app.template_filter('ymd')
-def ymd(s):
-    dt = _parse_dt(s)
-    return dt.strftime("%Y-%m-%d") if dt else (s or "")
+def ymd(s): return _format_dt(s, 'ymd')
 
 @app.template_filter('ymd_hm')
-def ymd_hm(s):
-    dt = _parse_dt(s)
-    return dt.strftime("%Y-%m-%d %H:%M") if dt else (s or "")
+def ymd_hm(s): return _format_dt(s, 'ymd_hm')
 
 # ---------- utils ----------
 def login_required(f):
@@ -98,6 +939,129 @@ def login_required(f):
 
 def make_dicts(rows): return [dict(r) for r in rows]
 
+# ---------- user directory ----------
+# Danh sách người dùng ít thay đổi nên được giữ trong bộ nhớ từng tiến trình. Trigger trên users tăng
+# data_versions('users') ở mọi thay đổi (add_user, edit_user, profile, create-admin…), mỗi request
+# chỉ đọc số phiên bản đó và nạp lại khi khác -> nhất quán giữa nhiều worker.
+_user_dir = {'version': None, 'by_id': {}, 'by_name': []}
+
+def data_version(db, name):
+    row = db.execute("SELECT version FROM data_versions WHERE name=?", (name,)).fetchone()
+    return row[0] if row else 0
+
+def user_directory(db):
+    global _user_dir
+    version = data_version(db, 'users')  # đọc trước khi nạp: bản nạp luôn mới ít nhất bằng phiên bản này
+    if _user_dir['version'] != version:
+        rows = make_dicts(db.execute("""
+            SELECT id, username, full_name, position, role, COALESCE(avatar, '') AS avatar, row_version
+            FROM users ORDER BY full_name
+        """))
+        _user_dir = {'version': version, 'by_id': {r['id']: r for r in rows}, 'by_name': rows}
+    return _user_dir
+
+def handler_choices(db):
+    return [{'id': u['id'], 'full_name': u['full_name']} for u in user_directory(db)['by_name']]
+
+def resolve_handlers(db, docs):
+    by_id = user_directory(db)['by_id']
+    for d in docs:
+        u = by_id.get(d.get('handler_id'))
+        d['handler_name'] = u['full_name'] if u else None
+    return docs
+
+# ---------- view cache ----------
+# Kết quả truy vấn của trang Tài liệu/trình xem được cache theo khóa gồm bộ lọc đã chuẩn hóa và phiên bản dữ liệu
+# (data_versions do trigger tăng ở mọi thay đổi) nên không bao giờ trả dữ liệu cũ; mục cũ tự rơi ra theo LRU.
+# Chỉ cache dữ liệu, không cache HTML: layout chứa người đăng nhập và thông báo flash.
+def current_versions(db):
+    return dict(db.execute("SELECT name, version FROM data_versions"))
+
+# Mỗi kiểu cache có get(key) -> bytes | None và put(key, bytes); chọn bằng VIEW_CACHE qua VIEW_CACHES.
+class MemoryViewCache:
+    # LRU trong bộ nhớ tiến trình, giới hạn theo số mục và tổng kích thước (giá trị lưu dạng pickle)
+    def __init__(self):
+        self.items, self.size, self.lock = OrderedDict(), 0, threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            raw = self.items.get(key)
+            if raw is not None: self.items.move_to_end(key)
+            return raw
+
+    def put(self, key, value):
+        with self.lock:
+            old = self.items.pop(key, None)
+            if old is not None: self.size -= len(old)
+            self.items[key] = value; self.size += len(value)
+            while self.items and (len(self.items) > app.config['VIEW_CACHE_MAX_ENTRIES']
+                                  or self.size > app.config['VIEW_CACHE_MAX_BYTES']):
+                self.size -= len(self.items.popitem(last=False)[1])
+
+class SqliteViewCache:
+    # tệp SQLite riêng dùng chung giữa các worker; thời điểm truy cập chỉ cập nhật khi cũ hơn 60 giây
+    def __init__(self):
+        self.local, self.puts = threading.local(), 0
+
+    def _db(self):
+        key = (os.getpid(), app.config['VIEW_CACHE_PATH'])
+        if getattr(self.local, 'key', None) != key:
+            db = sqlite3.connect(app.config['VIEW_CACHE_PATH'], isolation_level=None, timeout=1)
+            db.execute("PRAGMA journal_mode = WAL"); db.execute("PRAGMA synchronous = OFF")
+            db.execute("""CREATE TABLE IF NOT EXISTS view_cache (
+                key TEXT PRIMARY KEY, value BLOB NOT NULL, accessed REAL NOT NULL)""")
+            db.execute("CREATE INDEX IF NOT EXISTS idx_view_cache_accessed ON view_cache (accessed)")
+            self.local.db, self.local.key = db, key
+        return self.local.db
+
+    def get(self, key):
+        db, now = self._db(), time.time()
+        row = db.execute("SELECT value, accessed FROM view_cache WHERE key=?", (key,)).fetchone()
+        if not row: return None
+        if row[1] < now - 60: db.execute("UPDATE view_cache SET accessed=? WHERE key=?", (now, key))
+        return row[0]
+
+    def put(self, key, value):
+        db = self._db()
+        db.execute("INSERT OR REPLACE INTO view_cache (key, value, accessed) VALUES (?,?,?)", (key, value, time.time()))
+        self.puts += 1
+        if self.puts % 32: return
+        db.execute("""
+            DELETE FROM view_cache WHERE key IN (
+                SELECT key FROM (SELECT key, ROW_NUMBER() OVER w AS n, SUM(length(value)) OVER w AS total
+                                 FROM view_cache WINDOW w AS (ORDER BY accessed DESC))
+                WHERE n > ? OR total > ?)
+        """, (app.config['VIEW_CACHE_MAX_ENTRIES'], app.config['VIEW_CACHE_MAX_BYTES']))
+
+VIEW_CACHES = {'memory': MemoryViewCache, 'sqlite': SqliteViewCache}
+_view_cache = {'key': None, 'cache': None}
+
+def get_view_cache():
+    backend = app.config['VIEW_CACHE']
+    if not backend: return None
+    key = (os.getpid(), backend)
+    if _view_cache['key'] != key:
+        if backend not in VIEW_CACHES: raise RuntimeError(f"VIEW_CACHE không hợp lệ: {backend}")
+        _view_cache.update(key=key, cache=VIEW_CACHES[backend]())
+    return _view_cache['cache']
+
+def cached_view(view, parts, build):
+    # parts phải chứa mọi thứ kết quả phụ thuộc, kể cả phiên bản dữ liệu
+    cache = get_view_cache()
+    if cache is None: return build()
+    key = view + ":" + hashlib.sha1(json.dumps(parts, default=str, sort_keys=True).encode()).hexdigest()
+    try: raw = cache.get(key)
+    except sqlite3.Error as e:
+        app.logger.warning("view cache: %s", e); raw = None
+    if raw is not None:
+        metric_inc('view_cache_total', labels=(view, 'hit'))
+        return pickle.loads(raw)
+    metric_inc('view_cache_total', labels=(view, 'miss'))
+    value = build()
+    try: cache.put(key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+    except sqlite3.Error as e: app.logger.warning("view cache: %s", e)
+    return value
+
 def unique_secure_filename(filename: str) -> str:
     name, ext = os.path.splitext(secure_filename(filename))
     return f"{name}_{datetime.utcnow().strftime('%Y%m%d%H%M%S')}{ext}"
@@ -107,39 +1071,922 @@ def delete_file_safe(p):
         if p and os.path.exists(p): os.remove(p)
     except Exception: pass
 
+# ---------- blob store ----------
+# Tệp tải lên được lưu theo nội dung: uploads/blobs/ab/cd/<sha256><ext>. Cùng một nội dung chỉ lưu
+# (và trích xuất) một lần; blobs.refcount do trigger trên documents duy trì.
+BLOB_DIR = 'blobs'
+
+def upload_abs(p):
+    if not p: return p
+    return p if os.path.isabs(p) else os.path.join(app.config['UPLOAD_FOLDER'], p)
+
+@app.template_filter('upload_rel')
+def upload_rel(p):
+    # đường dẫn cũ là tuyệt đối, đường dẫn blob là tương đối so với UPLOAD_FOLDER
+    if not p: return ""
+    if os.path.isabs(p): p = os.path.relpath(p, app.config['UPLOAD_FOLDER'])
+    return p.replace('\\', '/')
+
+def store_blob(db, stream, filename):
+    ext = os.path.splitext(secure_filename(filename))[1].lower()
+    tmp_dir = os.path.join(app.config['UPLOAD_FOLDER'], BLOB_DIR, 'tmp')
+    os.makedirs(tmp_dir, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=tmp_dir)
+    try:
+        h, size = hashlib.sha256(), 0
+        with os.fdopen(fd, 'wb') as out:
+            for chunk in iter(lambda: stream.read(1 << 20), b''):
+                h.update(chunk); out.write(chunk); size += len(chunk)
+        digest = h.hexdigest()
+        row = db.execute("SELECT path FROM blobs WHERE hash=?", (digest,)).fetchone()
+        rel = row['path'] if row else f"{BLOB_DIR}/{digest[:2]}/{digest[2:4]}/{digest}{ext}"
+        dest = upload_abs(rel)
+        if not os.path.exists(dest):
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            os.replace(tmp, dest); tmp = None
+        if not row:
+            db.execute("INSERT OR IGNORE INTO blobs (hash, path, size) VALUES (?,?,?)", (digest, rel, size))
+        else:  # dùng lại blob chưa có tham chiếu: tính lại thời hạn ân hạn của gc-blobs từ bây giờ
+            db.execute("UPDATE blobs SET created_at = CURRENT_TIMESTAMP WHERE hash=? AND refcount <= 0", (digest,))
+        metric_inc('upload_bytes_total', size)
+        return rel
+    finally:
+        if tmp: delete_file_safe(tmp)
+
+def release_files(db, paths):
+    # gọi SAU khi đã xóa/đổi tham chiếu trong documents; trả về các tệp cần xóa sau khi commit
+    doomed = []
+    for p in filter(None, paths):
+        blob = db.execute("SELECT hash, refcount FROM blobs WHERE path=?", (p,)).fetchone()
+        if blob:
+            if blob['refcount'] > 0: continue
+            db.execute("DELETE FROM blobs WHERE hash=?", (blob['hash'],))
+        elif db.execute("SELECT 1 FROM documents WHERE original_file_path=? OR translated_file_path=?",
+                        (p, p)).fetchone():
+            continue  # tệp cũ (lưu theo tên) vẫn còn tài liệu khác dùng
+        doomed.append(upload_abs(p))
+    return doomed
+
+def gc_blobs(db, grace=3600, dry_run=False):
+    db.execute("""
+        UPDATE blobs SET refcount =
+            (SELECT COUNT(*) FROM documents WHERE original_file_path = blobs.path) +
+            (SELECT COUNT(*) FROM documents WHERE translated_file_path = blobs.path)
+    """)
+    # blob chưa có tài liệu nào dùng nhưng mới tạo/mới dùng lại trong `grace` giây được giữ lại: upload hoặc
+    # import-docs lưu blob trước, tài liệu tham chiếu tới nó được commit sau (có thể ở giao dịch sau)
+    dead = db.execute("SELECT hash, path, size FROM blobs WHERE refcount <= 0 AND created_at < datetime('now', ?)",
+                      (f"-{int(grace)} seconds",)).fetchall()
+    doomed = {r['path'] for r in dead}
+    known = {r[0] for r in db.execute("SELECT path FROM blobs")} - doomed
+    if not dry_run:
+        db.executemany("DELETE FROM blobs WHERE hash=?", [(r['hash'],) for r in dead])
+    db.commit()
+    removed = [(upload_abs(r['path']), r['size']) for r in dead]
+    root = os.path.join(app.config['UPLOAD_FOLDER'], BLOB_DIR)
+    cutoff = time.time() - grace
+    for dirpath, _, files in os.walk(root):
+        for name in files:
+            full = os.path.join(dirpath, name)
+            rel = os.path.relpath(full, app.config['UPLOAD_FOLDER']).replace(os.sep, '/')
+            if rel in known or any(full == r[0] for r in removed): continue
+            try: st = os.stat(full)
+            except OSError: continue
+            if st.st_mtime < cutoff: removed.append((full, st.st_size))  # mồ côi (ví dụ upload bị ngắt)
+    if not dry_run:
+        for full, _ in removed: delete_file_safe(full)
+    return removed
+
+# ---------- avatars ----------
+# Ảnh đại diện được giải mã, cắt vuông ở giữa và mã hóa lại thành vài cỡ cố định (bỏ toàn bộ metadata: EXIF, GPS…).
+# users.avatar lưu 'avatars/<hash>.<ext>'; các biến thể là 'avatars/<hash>_<cỡ>.<ext>', tên theo nội dung nên
+# được cache vĩnh viễn. Ảnh cũ lưu nguyên bản (tên bất kỳ) vẫn hiển thị được cho tới khi chạy `flask rebuild-avatars`.
+AVATAR_DIR = 'avatars'
+AVATAR_RE = re.compile(r'^avatars/([0-9a-f]{32})\.(jpg|png)$')
+AVATAR_VARIANT_RE = re.compile(r'^avatars/([0-9a-f]{32})_(\d+)\.(jpg|png)$')
+
+def image_size(data):
+    # kích thước (rộng, cao) đọc từ phần đầu tệp, không giải mã điểm ảnh: PNG, JPEG, GIF, BMP
+    if data[:8] == b'\x89PNG\r\n\x1a\n' and data[12:16] == b'IHDR' and len(data) >= 24:
+        return struct.unpack('>II', data[16:24])
+    if data[:6] in (b'GIF87a', b'GIF89a') and len(data) >= 10:
+        return struct.unpack('<HH', data[6:10])
+    if data[:2] == b'BM' and len(data) >= 26:
+        w, h = struct.unpack('<ii', data[18:26]); return abs(w), abs(h)
+    if data[:2] == b'\xff\xd8':
+        i = 2
+        while i + 9 <= len(data):
+            if data[i] != 0xFF: raise ValueError("JPEG hỏng")
+            marker = data[i + 1]
+            if marker == 0xFF: i += 1; continue  # byte đệm
+            if marker == 0x01 or 0xD0 <= marker <= 0xD8: i += 2; continue  # marker không có độ dài
+            if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):  # SOFn
+                h, w = struct.unpack('>HH', data[i + 5:i + 9]); return w, h
+            i += 2 + int.from_bytes(data[i + 2:i + 4], 'big')
+    raise ValueError("định dạng ảnh không hỗ trợ (PNG, JPEG, GIF, BMP)")
+
+def process_avatar(data):
+    if len(data) > app.config['AVATAR_MAX_BYTES']: raise ValueError("ảnh quá lớn")
+    # kiểm tra số điểm ảnh TRƯỚC khi giải mã: PNG 12000×12000 chỉ vài trăm KB nhưng giải mã ra hàng trăm MB
+    w, h = image_size(data)
+    if not w or not h or w * h > app.config['AVATAR_MAX_PIXELS']: raise ValueError("ảnh quá lớn")
+    pix = fitz.Pixmap(data)
+    if not pix.colorspace or pix.colorspace.n != 3: pix = fitz.Pixmap(fitz.csRGB, pix)
+    side = min(pix.width, pix.height)
+    x0, y0 = (pix.width - side) // 2, (pix.height - side) // 2
+    square = fitz.Pixmap(pix.colorspace, fitz.IRect(x0, y0, x0 + side, y0 + side), pix.alpha)
+    square.copy(pix, square.irect); square.set_origin(0, 0)
+    # ảnh trong suốt giữ PNG, còn lại JPEG
+    ext = 'png' if pix.alpha else 'jpg'
+    encode = (lambda p: p.tobytes('png')) if pix.alpha else \
+        (lambda p: p.tobytes('jpg', jpg_quality=app.config['AVATAR_JPEG_QUALITY']))
+    variants = {size: encode(fitz.Pixmap(square, size, size)) for size in app.config['AVATAR_SIZES']}
+    digest = hashlib.sha256(variants[max(variants)]).hexdigest()[:32]
+    return f"{AVATAR_DIR}/{digest}.{ext}", variants
+
+def avatar_variant(p, size):
+    m = AVATAR_RE.match(p or '')
+    return f"{AVATAR_DIR}/{m.group(1)}_{size}.{m.group(2)}" if m else p
+
+def save_avatar(data):
+    rel, variants = process_avatar(data)
+    for size, body in variants.items():
+        dest = upload_abs(avatar_variant(rel, size))
+        if os.path.exists(dest): continue  # cùng nội dung đã có
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        with open(dest + '.tmp', 'wb') as fh: fh.write(body)
+        os.replace(dest + '.tmp', dest)
+    metric_inc('upload_bytes_total', len(data))
+    return rel
+
+def release_avatar(db, p):
+    # gọi sau khi commit; ảnh trùng nội dung có thể đang được người khác dùng
+    if not p or db.execute("SELECT 1 FROM users WHERE avatar=?", (p,)).fetchone(): return
+    if AVATAR_RE.match(p):
+        for size in app.config['AVATAR_SIZES']: delete_file_safe(upload_abs(avatar_variant(p, size)))
+    else:
+        delete_file_safe(upload_abs(p))
+
+@app.template_filter('avatar_url')
+def avatar_url(p, size=64):
+    # biến thể nhỏ nhất không nhỏ hơn size (px cần tải, thường ~2 lần cỡ hiển thị); ảnh cũ trả nguyên bản
+    if not p: return ""
+    size = min([s for s in app.config['AVATAR_SIZES'] if s >= size] or [max(app.config['AVATAR_SIZES'])])
+    return url_for('serve_upload', filename=avatar_variant(p, size))
+
+# ---------- page render cache ----------
+# Trang PDF (và ảnh) được PyMuPDF render thành JPEG theo yêu cầu, cache trên đĩa theo
+# (phiên bản tệp, trang, cỡ). Vượt RENDER_CACHE_MAX_BYTES thì xóa các ảnh lâu không dùng nhất.
+RENDER_SIZES = {'thumb': 160, 'sm': 480, 'md': 960, 'lg': 1600}  # chiều rộng (px)
+RENDER_EXTS = ('pdf', 'png', 'jpg', 'jpeg', 'gif', 'bmp', 'tif', 'tiff')
+
+@app.template_filter('file_version')
+def file_version(p):
+    # blob: chính là hash nội dung; tệp cũ: theo đường dẫn + mtime + kích thước
+    rel = upload_rel(p)
+    if rel.startswith(BLOB_DIR + '/'): return os.path.splitext(rel.rsplit('/', 1)[-1])[0]
+    try: st = os.stat(upload_abs(p))
+    except OSError: return None
+    return hashlib.sha256(f"{rel}|{st.st_mtime_ns}|{st.st_size}".encode()).hexdigest()
+
+@app.template_filter('renderable')
+def renderable(p):
+    return bool(p) and os.path.splitext(p)[1].lower().lstrip('.') in RENDER_EXTS
+
+@lru_cache(maxsize=1024)
+def _page_count(path, version):
+    with fitz.open(path) as d: return d.page_count
+
+def render_page_count(p):
+    version = file_version(p)
+    if not version: return 0
+    try: return _page_count(upload_abs(p), version)
+    except Exception: return 0
+
+def render_page(p, version, page_no, size):
+    root = app.config['RENDER_CACHE_DIR']
+    out = os.path.join(root, version[:2], f"{version}-{page_no}-{size}.jpg")
+    if cache_dir_get(out): return out
+    with fitz.open(upload_abs(p)) as d:
+        if not 1 <= page_no <= d.page_count: return None
+        page = d[page_no - 1]
+        zoom = min(RENDER_SIZES[size] / max(page.rect.width, 1), 8)
+        pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+        data = pix.tobytes('jpeg', jpg_quality=app.config['RENDER_JPEG_QUALITY'])
+    cache_dir_put(root, app.config['RENDER_CACHE_MAX_BYTES'], out, data)
+    return out
+
+# Các thư mục cache trên đĩa (ảnh trang, bản xem trước DOCX) dùng chung cơ chế LRU theo mtime:
+# kích thước được ước lượng trong tiến trình và chỉ quét lại thư mục khi chạm ngưỡng.
+_cache_dir_bytes = {}
+
+def cache_dir_add(root, cap, n, keep):
+    cur = _cache_dir_bytes.get(root)
+    if cur is None or cur + n > cap:
+        _cache_dir_bytes[root] = prune_cache_dir(root, cap, keep)
+    else:
+        _cache_dir_bytes[root] = cur + n
+
+def prune_cache_dir(root, cap, keep=None):
+    entries = []
+    for dirpath, _, files in os.walk(root):
+        for name in files:
+            full = os.path.join(dirpath, name)
+            if name.startswith('tmp') or full == keep: continue  # tệp tạm đang ghi / vừa tạo
+            try: st = os.stat(full)
+            except OSError: continue
+            entries.append((st.st_mtime, st.st_size, full))
+    total = sum(e[1] for e in entries)
+    if total <= cap: return total
+    entries.sort()
+    for _, size, full in entries:
+        if total <= cap * 0.9: break  # chừa khoảng trống để không phải quét lại ở mỗi lần ghi
+        delete_file_safe(full); total -= size
+    return total
+
+def cache_dir_get(path):
+    if not os.path.exists(path): return False
+    try: os.utime(path)  # đánh dấu vừa dùng
+    except OSError: pass
+    return True
+
+def cache_dir_put(root, cap, path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'wb') as f: f.write(data)
+    os.replace(tmp, path)
+    cache_dir_add(root, cap, len(data), path)
+
+def versioned_cache(resp, version):
+    # URL có ?v=<phiên bản tệp> khớp thì nội dung không đổi -> cache vĩnh viễn, ngược lại luôn hỏi lại (ETag)
+    resp.cache_control.private = True
+    if request.args.get('v') == version:
+        resp.cache_control.no_cache = None
+        resp.cache_control.max_age = 31536000
+        resp.cache_control.immutable = True
+    else:
+        resp.cache_control.no_cache = True
+    return resp
+
+# ---------- DOCX preview ----------
+# DOCX được chuyển sang một đoạn HTML gọn (giữ tiêu đề, danh sách, bảng) một lần cho mỗi nội dung tệp,
+# lưu nén gzip trong PREVIEW_CACHE_DIR theo phiên bản tệp.
+def _docx_list_tag(doc, p, fmts):
+    ppr = p._p.pPr
+    num = ppr.numPr if ppr is not None else None
+    if num is None and p.style is not None and p.style.element.pPr is not None:
+        num = p.style.element.pPr.numPr  # đánh số khai báo trong style (List Bullet, List Number…)
+    if num is None or num.numId is None:
+        return None, 0
+    num_id, ilvl = num.numId.val, (num.ilvl.val if num.ilvl is not None else 0)
+    if not num_id: return None, 0  # numId=0: đã tắt đánh số
+    lvl = ilvl
+    m = re.match(r'List .* (\d)$', p.style.name if p.style is not None else '')
+    if num.ilvl is None and m: lvl = int(m.group(1)) - 1  # "List Bullet 2" = cấp 2
+    if (num_id, ilvl) not in fmts:
+        fmt = 'decimal'
+        try:
+            numbering = doc.part.numbering_part.element
+            aid = numbering.num_having_numId(num_id).abstractNumId.val
+            found = numbering.xpath(f'w:abstractNum[@w:abstractNumId="{aid}"]/w:lvl[@w:ilvl="{ilvl}"]/w:numFmt/@w:val')
+            if found: fmt = found[0]
+        except (KeyError, NotImplementedError, AttributeError):
+            pass
+        fmts[(num_id, ilvl)] = 'ul' if fmt == 'bullet' else 'ol'
+    return fmts[(num_id, ilvl)], lvl
+
+def _docx_runs_html(p):
+    out = []
+    for r in p._p.iter(qn('w:r')):  # kể cả run nằm trong hyperlink
+        run = Run(r, p)
+        text = str(escape(run.text)).replace('\n', '<br>').replace('\t', ' ')
+        if not text: continue
+        if run.bold: text = f"<strong>{text}</strong>"
+        if run.italic: text = f"<em>{text}</em>"
+        if run.underline: text = f"<u>{text}</u>"
+        out.append(text)
+    return ''.join(out)
+
+def _docx_table_html(doc, tbl):
+    rows = []
+    for tr in tbl._tbl.tr_lst:
+        cells = []
+        for tc in tr.tc_lst:
+            if tc.vMerge == 'continue':
+                cells.append('<td></td>'); continue  # phần dưới của ô gộp dọc
+            span = f' colspan="{tc.grid_span}"' if tc.grid_span > 1 else ''
+            body = '<br>'.join(_docx_runs_html(Paragraph(p, doc)) for p in tc.p_lst)
+            cells.append(f'<td{span}>{body}</td>')
+        rows.append('<tr>' + ''.join(cells) + '</tr>')
+    return '<table>' + ''.join(rows) + '</table>'
+
+def docx_to_html(path):
+    doc = docx.Document(path)
+    out, stack, fmts = [], [], {}  # stack: các danh sách đang mở [(thẻ, cấp)]
+    def close_list():
+        out.append(f"</li></{stack.pop()[0]}>")
+    for el in doc.element.body.iterchildren():
+        if el.tag == qn('w:tbl'):
+            while stack: close_list()
+            out.append(_docx_table_html(doc, Table(el, doc)))
+            continue
+        if el.tag != qn('w:p'): continue
+        p = Paragraph(el, doc)
+        html = _docx_runs_html(p)
+        tag, lvl = _docx_list_tag(doc, p, fmts)
+        if tag:
+            while stack and (stack[-1][1] > lvl or (stack[-1][1] == lvl and stack[-1][0] != tag)): close_list()
+            if stack and stack[-1][1] == lvl:
+                out.append('</li><li>')
+            else:
+                out.append(f'<{tag}><li>'); stack.append((tag, lvl))
+            out.append(html); continue
+        while stack: close_list()
+        if not html: continue
+        style = p.style.name if p.style is not None else ''
+        m = re.match(r'Heading (\d)', style)
+        if style == 'Title': out.append(f'<h1>{html}</h1>')
+        elif m: out.append(f'<h{min(int(m.group(1)) + 1, 6)}>{html}</h{min(int(m.group(1)) + 1, 6)}>')
+        else: out.append(f'<p>{html}</p>')
+    while stack: close_list()
+    return ''.join(out)
+
+def docx_preview(p, version):
+    # trả về HTML đã nén gzip (lấy từ cache hoặc chuyển đổi mới)
+    root = app.config['PREVIEW_CACHE_DIR']
+    out = os.path.join(root, version[:2], f"{version}.html.gz")
+    if cache_dir_get(out):
+        with open(out, 'rb') as f: return f.read()
+    data = gzip.compress(docx_to_html(upload_abs(p)).encode('utf-8'), compresslevel=6, mtime=0)
+    cache_dir_put(root, app.config['PREVIEW_CACHE_MAX_BYTES'], out, data)
+    return data
+
+def encode_cursor(data):
+    raw = json.dumps(data, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def _sql_int(v, lo=-2**63):
+    return type(v) is int and lo <= v < 2**63  # bool không tính; ngoài khoảng INTEGER của SQLite -> OverflowError
+
+def decode_cursor(token):
+    # con trỏ đến từ URL: chỉ nhận {'k': [created_at, id]} hoặc {'o': offset >= 0}, còn lại coi như không có
+    if not token: return None
+    try:
+        data = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(data, dict) or not ('k' in data or 'o' in data): return None
+    k = data.get('k')
+    if k is not None and not (isinstance(k, list) and len(k) == 2 and isinstance(k[0], str) and _sql_int(k[1])):
+        return None
+    if 'o' in data and not _sql_int(data['o'], 0): return None
+    return data
+
+# Tổng số kết quả lọc chỉ để hiển thị nên được cache ngắn hạn theo (câu lệnh, tham số)
+# thay vì đếm lại toàn bộ tập kết quả ở mỗi lần chuyển trang. LIST_COUNT_TTL = 0 để đếm chính xác.
+_count_cache = {}
+
+def cached_count(db, sql, prm, version=None):
+    # version: phiên bản dữ liệu (data_versions) -> số đếm không dùng lại qua một lần ghi
+    ttl = app.config['LIST_COUNT_TTL']
+    key = (sql, tuple(prm), version)
+    hit = _count_cache.get(key)
+    now = time.monotonic()
+    if ttl and hit and hit[0] > now: return hit[1]
+    n = db.execute(sql, prm).fetchone()[0]
+    if ttl:
+        if len(_count_cache) >= 512: _count_cache.clear()
+        _count_cache[key] = (now + ttl, n)
+    return n
+
+def extract_pdf_pages(path, start, stop):
+    with fitz.open(path) as d:
+        return [(i + 1, d[i].get_text()) for i in range(start, stop)]
+
+def extract_docx_pages(path):
+    # DOCX không có khái niệm trang -> lưu thành một "trang"
+    doc = docx.Document(path)
+    return [(1, "\n".join([p.text for p in doc.paragraphs if p.text]))]
+
+def extraction_plan(path, chunk):
+    # chia PDF thành các khoảng trang [start, stop) để trích xuất song song
+    if not path or not os.path.exists(path): return []
+    ext = os.path.splitext(path)[1].lower().lstrip('.')
+    if ext in ('pdf', 'docx'):
+        metric_inc('extract_files_total', labels=(ext,))
+        metric_inc('extract_bytes_total', os.path.getsize(path), labels=(ext,))
+    if path.lower().endswith('.pdf'):
+        with fitz.open(path) as d: n = d.page_count
+        return [(extract_pdf_pages, (path, s, min(s + chunk, n))) for s in range(0, n, chunk)]
+    if path.lower().endswith('.docx'):
+        return [(extract_docx_pages, (path,))]
+    return []
+
+def timed_part(fn, args):
+    # chạy trong tiến trình con: trả kèm thời gian để tiến trình cha ghi số liệu
+    # (tiến trình của pool thoát không qua atexit nên không tự ghi được)
+    t = time.perf_counter()
+    return fn(*args), time.perf_counter() - t, os.path.splitext(args[0])[1].lower().lstrip('.')
+
+def part_pages(result):
+    pages, seconds, ext = result
+    metric_observe('extract_duration_seconds', seconds, (ext,))
+    return pages
+
+def extract_text(path):
+    # như read_text_from_file nhưng ném lỗi để hàng đợi có thể thử lại
+    return "".join(text for fn, args in extraction_plan(path, 1 << 30)
+                   for _, text in part_pages(timed_part(fn, args)))
+
 def read_text_from_file(path):
-    if not path or not os.path.exists(path): return ""
     try:
-        if path.lower().endswith('.docx'):
-            doc = docx.Document(path)
-            return "\n".join([p.text for p in doc.paragraphs if p.text])
-        if path.lower().endswith('.pdf'):
-            out=""; 
-            with fitz.open(path) as d:
-                for page in d: out += page.get_text()
-            return out
+        return extract_text(path)
     except Exception as e:
         return f"Lỗi nghiêm trọng khi đọc file: {e}. Vui lòng kiểm tra lại file."
-    return ""
 
-def get_summary_from_gemini(text):
-    if not text or "Lỗi" in text:
-        return "Nội dung trống hoặc file lỗi, không thể tóm tắt."
-    return f"[TÓM TẮT TỰ ĐỘNG (GIẢ LẬP)] {' '.join(text.split()[:50])}..."
+def fts_query(q):
+    # mỗi từ là một cụm trong ngoặc kép (AND), từ cuối cho phép khớp tiền tố
+    words = re.findall(r"\w+", q.replace('đ', 'd').replace('Đ', 'D'))
+    if not words: return ""
+    return " ".join(f'"{w}"' for w in words) + "*"
 
-# ---------- routes ----------
-@app.route('/')
-@login_required
-def dashboard():
-    db = get_db()
-    stats = {
-        "total":       db.execute('SELECT COUNT(id) FROM documents').fetchone()[0],
-        "processing":  db.execute("SELECT COUNT(id) FROM documents WHERE status='Đang xử lý'").fetchone()[0],
-        "completed":   db.execute("SELECT COUNT(id) FROM documents WHERE status='Đã xử lý'").fetchone()[0],
-        "unassigned":  db.execute("SELECT COUNT(id) FROM documents WHERE status='Chưa xử lý'").fetchone()[0],
-    }
+SNIPPET_OPEN, SNIPPET_CLOSE = "\x02", "\x03"
 
-    args = request.args
+@app.template_filter('snippet_html')
+def snippet_html(s):
+    if not s: return ""
+    return Markup(str(escape(s)).replace(SNIPPET_OPEN, "<mark>").replace(SNIPPET_CLOSE, "</mark>"))
+
+# ---------- summarization ----------
+# Bộ tóm tắt thay thế được qua SUMMARIZER. Tài liệu cần tóm tắt có document_contents.summary_status='pending';
+# worker gom thành lô, gọi song song có giới hạn và thời hạn. Kết quả lưu trong summary_cache theo hash
+# văn bản đầu vào nên tải lại cùng nội dung không phải tóm tắt lại.
+EMPTY_SUMMARY = "Nội dung trống hoặc file lỗi, không thể tóm tắt."
+
+# Mỗi bộ tóm tắt có name (nằm trong khóa summary_cache) và summarize_batch(texts) -> danh sách cùng thứ tự.
+class LocalSummarizer:
+    # giả lập: lấy 50 từ đầu
+    name = 'local'
+
+    def summarize_batch(self, texts):
+        return [f"[TÓM TẮT TỰ ĐỘNG (GIẢ LẬP)] {' '.join(t.split()[:50])}..." for t in texts]
+
+class RemoteSummarizer:
+    # POST {"model": ..., "texts": [...]} -> {"summaries": [...]} (cùng thứ tự)
+    def __init__(self, url, model, api_key=None, timeout=60):
+        if not url: raise RuntimeError("Chưa cấu hình SUMMARIZER_URL.")
+        self.url, self.model, self.api_key, self.timeout = url, model, api_key, timeout
+        self.name = f"remote:{model}"
+
+    def summarize_batch(self, texts):
+        headers = {'Content-Type': 'application/json'}
+        if self.api_key: headers['Authorization'] = f"Bearer {self.api_key}"
+        body = json.dumps({"model": self.model, "texts": texts}).encode('utf-8')
+        req = urllib.request.Request(self.url, data=body, headers=headers, method='POST')
+        with urllib.request.urlopen(req, timeout=self.timeout) as r:
+            out = json.loads(r.read().decode('utf-8'))['summaries']
+        if len(out) != len(texts): raise ValueError(f"nhận {len(out)} bản tóm tắt cho {len(texts)} văn bản")
+        return out
+
+SUMMARIZERS = {
+    'local': lambda cfg: LocalSummarizer(),
+    'remote': lambda cfg: RemoteSummarizer(cfg['SUMMARIZER_URL'], cfg['SUMMARIZER_MODEL'],
+                                           cfg['SUMMARIZER_API_KEY'], cfg['SUMMARY_TIMEOUT']),
+}
+
+def get_summarizer():
+    return SUMMARIZERS[app.config['SUMMARIZER']](app.config)
+
+def queue_summary(db, doc_id):
+    db.execute("""
+        UPDATE document_contents SET summary_status='pending', summary_attempts=0, summary_run_after=0,
+               summary_error=NULL
+        WHERE document_id=?
+    """, (doc_id,))
+
+def claim_summaries(db, limit, doc_id=None):
+    now = time.time()
+    return db.execute("""
+        UPDATE document_contents SET summary_status='running', summary_attempts=summary_attempts+1,
+               summary_run_after=?
+        WHERE document_id IN (
+            SELECT document_id FROM document_contents
+            WHERE summary_status IN ('pending', 'running') AND summary_run_after <= ?
+              AND (? IS NULL OR document_id = ?)
+            ORDER BY summary_run_after LIMIT ?
+        )
+        RETURNING document_id, summary_attempts
+    """, (now + 2 * app.config['SUMMARY_TIMEOUT'], now, doc_id, doc_id, limit)).fetchall()
+
+def _finish_summary(db, doc_id, summary):
+    # không ghi đè nội dung người dùng đã nhập trong lúc chờ
+    db.execute("""
+        UPDATE document_contents SET main_content_summary=COALESCE(main_content_summary, ?),
+               summary_status='ready', summary_error=NULL
+        WHERE document_id=? AND summary_status='running'
+    """, (pack_text(summary), doc_id))
+
+def prepare_summaries(db, limit, doc_id=None):
+    # nhận việc, trả lời ngay những gì có trong cache; phần còn lại gom theo hash thành các lô
+    summarizer = get_summarizer()
+    claimed = claim_summaries(db, limit, doc_id)
+    todo = {}  # key -> (văn bản, [việc])
+    for r in claimed:
+        text = document_text(db, r['document_id'], 'translated')[:app.config['SUMMARY_MAX_CHARS']]
+        if not text.strip():
+            _finish_summary(db, r['document_id'], EMPTY_SUMMARY); continue
+        key = hashlib.sha256(f"{summarizer.name}\0{text}".encode('utf-8')).hexdigest()
+        hit = db.execute("SELECT summary FROM summary_cache WHERE key=?", (key,)).fetchone()
+        if hit:
+            _finish_summary(db, r['document_id'], unpack_text(hit[0])); continue
+        todo.setdefault(key, (text, []))[1].append(dict(r))
+    db.commit()
+    items, size = list(todo.items()), app.config['SUMMARY_BATCH_SIZE']
+    return summarizer, [items[i:i + size] for i in range(0, len(items), size)], len(claimed)
+
+def store_summaries(db, summarizer, batch, summaries):
+    for (key, (_, jobs)), summary in zip(batch, summaries):
+        db.execute("INSERT OR REPLACE INTO summary_cache (key, summarizer, summary) VALUES (?,?,?)",
+                   (key, summarizer.name, pack_text(summary)))
+        for j in jobs: _finish_summary(db, j['document_id'], summary)
+    db.commit()
+
+def fail_summaries(db, batch, err):
+    msg = f"{type(err).__name__}: {err}"
+    for _, (_, jobs) in batch:
+        for j in jobs:
+            if j['summary_attempts'] < app.config['INGEST_MAX_ATTEMPTS']:
+                db.execute("""
+                    UPDATE document_contents SET summary_status='pending', summary_error=?, summary_run_after=?
+                    WHERE document_id=? AND summary_status='running'
+                """, (msg, time.time() + app.config['INGEST_RETRY_DELAY'] * j['summary_attempts'], j['document_id']))
+            else:
+                db.execute("""
+                    UPDATE document_contents SET summary_status='error', summary_error=?
+                    WHERE document_id=? AND summary_status='running'
+                """, (msg, j['document_id']))
+    db.commit()
+
+def submit_summaries(db, pool, inflight, doc_id=None):
+    # lấp đầy các suất gọi song song còn trống; trả về số việc đã nhận
+    slots = app.config['SUMMARY_CONCURRENCY'] - len(inflight)
+    if slots <= 0: return 0
+    summarizer, batches, n = prepare_summaries(db, slots * app.config['SUMMARY_BATCH_SIZE'], doc_id)
+    deadline = time.monotonic() + app.config['SUMMARY_TIMEOUT']
+    for batch in batches:
+        fut = pool.submit(summarizer.summarize_batch, [text for _, (text, _) in batch])
+        inflight[fut] = (summarizer, batch, deadline)
+    return n
+
+def collect_summaries(db, inflight, finished):
+    for fut in finished:
+        summarizer, batch, _ = inflight.pop(fut)
+        try: store_summaries(db, summarizer, batch, fut.result())
+        except Exception as e: fail_summaries(db, batch, e)
+    now = time.monotonic()
+    for fut, (_, batch, deadline) in list(inflight.items()):
+        if deadline < now:  # luồng vẫn chạy nhưng kết quả bị bỏ, việc được xếp lại
+            inflight.pop(fut)
+            fail_summaries(db, batch, TimeoutError(f"quá {app.config['SUMMARY_TIMEOUT']} giây"))
+
+def run_summaries(db, doc_id=None):
+    # chạy đồng bộ tới khi hết việc đến hạn (`flask summarize`, INGEST_ASYNC=False)
+    total, inflight = 0, {}
+    pool = ThreadPoolExecutor(max_workers=app.config['SUMMARY_CONCURRENCY'])
+    try:
+        while True:
+            total += submit_summaries(db, pool, inflight, doc_id)
+            if not inflight: return total
+            finished, _ = wait(inflight, timeout=1.0, return_when=FIRST_COMPLETED)
+            collect_summaries(db, inflight, finished)
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+# ---------- ingestion queue ----------
+# add_document chỉ lưu tệp và xếp việc vào ingest_jobs; `flask ingest-worker` lấy việc, chia PDF lớn
+# thành các khoảng trang, trích xuất song song trên pool tiến trình và ghi từng trang vào document_pages
+# ngay khi xong. Văn bản trang chỉ hiện ra với chỉ mục FTS khi ingest_status='ready'.
+def enqueue_ingest(db, doc_id, summarize):
+    db.execute("INSERT INTO ingest_jobs (document_id, summarize, max_attempts) VALUES (?,?,?)",
+               (doc_id, 1 if summarize else 0, app.config['INGEST_MAX_ATTEMPTS']))
+
+def claim_ingest_job(db, worker, doc_id=None):
+    now = time.time()
+    row = db.execute("""
+        UPDATE ingest_jobs SET status='running', attempts=attempts+1, locked_by=?, locked_at=?
+        WHERE id = (
+            SELECT id FROM ingest_jobs
+            WHERE ((status='pending' AND run_after <= ?) OR (status='running' AND locked_at < ?))
+              AND (? IS NULL OR document_id = ?)
+            ORDER BY id LIMIT 1
+        )
+        RETURNING id, document_id, summarize, attempts, max_attempts
+    """, (worker, now, now, now - app.config['INGEST_JOB_TIMEOUT'], doc_id, doc_id)).fetchone()
+    if not row:
+        db.commit(); return None
+    job = dict(row)
+    paths = db.execute("SELECT original_file_path, translated_file_path FROM documents WHERE id=?",
+                       (job['document_id'],)).fetchone()
+    db.commit()
+    if not paths:
+        # tài liệu đã bị xóa trong lúc chờ
+        db.execute("UPDATE ingest_jobs SET status='done' WHERE id=?", (job['id'],)); db.commit()
+        return claim_ingest_job(db, worker, doc_id)
+    job.update(dict(paths))
+    return job
+
+def reuse_extracted_pages(db, doc_id, kind, path):
+    # cùng blob đã được trích xuất cho tài liệu khác -> sao chép trang, không phân tích lại
+    if not path or not path.startswith(BLOB_DIR + '/'): return False
+    src = db.execute("""
+        SELECT id, CASE WHEN original_file_path = ? THEN 'original' ELSE 'translated' END AS kind
+        FROM documents
+        WHERE ingest_status = 'ready' AND id <> ? AND (original_file_path = ? OR translated_file_path = ?)
+        LIMIT 1
+    """, (path, doc_id, path, path)).fetchone()
+    if not src: return False
+    db.execute("""
+        INSERT INTO document_pages (document_id, kind, page_no, text)
+        SELECT ?, ?, page_no, text FROM document_pages WHERE document_id=? AND kind=?
+    """, (doc_id, kind, src['id'], src['kind']))
+    return True
+
+def start_ingest_job(db, job):
+    # xóa trang của lần thử trước rồi trả về danh sách phần việc (kind, hàm, tham số)
+    doc_id = job['document_id']
+    db.execute("DELETE FROM document_pages WHERE document_id=?", (doc_id,))
+    chunk = app.config['EXTRACT_CHUNK_PAGES']
+    parts = []
+    for kind in PAGE_KINDS:
+        path = job[f'{kind}_file_path']
+        if reuse_extracted_pages(db, doc_id, kind, path): continue
+        parts += [(kind, fn, args) for fn, args in extraction_plan(upload_abs(path), chunk)]
+    db.commit()
+    return parts
+
+def store_pages(db, doc_id, kind, pages):
+    db.executemany("INSERT OR REPLACE INTO document_pages (document_id, kind, page_no, text) VALUES (?,?,?,?)",
+                   ((doc_id, kind, no, pack_text(text)) for no, text in pages))
+    db.commit()
+
+def document_text(db, doc_id, kind):
+    return "".join(unpack_text(r[0]) or "" for r in db.execute(
+        "SELECT text FROM document_pages WHERE document_id=? AND kind=? ORDER BY page_no", (doc_id, kind)))
+
+COMPRESSED_COLUMNS = (('document_pages', 'id', 'text'), ('document_contents', 'document_id', 'main_content_summary'),
+                      ('summary_cache', 'key', 'summary'))
+
+def compress_stored_text(db, batch=500, commit=False):
+    # nén các giá trị TEXT còn lại theo lô khóa chính; trả {bảng: (số dòng đã nén, byte trước, byte sau)}
+    report = {}
+    for table, key, col in COMPRESSED_COLUMNS:
+        rows_done = before = after = 0
+        last = None
+        while True:
+            rows = db.execute(f"""
+                SELECT {key}, {col} FROM {table}
+                WHERE typeof({col}) = 'text' AND (? IS NULL OR {key} > ?) ORDER BY {key} LIMIT ?
+            """, (last, last, batch)).fetchall()
+            if not rows: break
+            last = rows[-1][0]
+            updates = []
+            for k, v in rows:
+                packed = pack_text(v)
+                if isinstance(packed, bytes):
+                    updates.append((packed, k)); before += len(v.encode('utf-8')); after += len(packed)
+            db.executemany(f"UPDATE {table} SET {col}=? WHERE {key}=?", updates)
+            rows_done += len(updates)
+            if commit: db.commit()
+        report[table] = (rows_done, before, after)
+    return report
+
+def complete_ingest_job(db, job):
+    doc_id = job['document_id']
+    if job['summarize'] and db.execute("SELECT 1 FROM document_contents WHERE document_id=? AND main_content_summary IS NULL",
+                                       (doc_id,)).fetchone():
+        queue_summary(db, doc_id)
+    db.execute("UPDATE documents SET ingest_status='ready' WHERE id=?", (doc_id,))
+    db.execute("UPDATE ingest_jobs SET status='done', error=NULL, locked_by=NULL WHERE id=?", (job['id'],))
+    db.commit()
+
+def fail_ingest_job(db, job, err):
+    msg = f"{type(err).__name__}: {err}"
+    if job['attempts'] < job['max_attempts']:
+        delay = app.config['INGEST_RETRY_DELAY'] * job['attempts']
+        db.execute("UPDATE ingest_jobs SET status='pending', error=?, locked_by=NULL, run_after=? WHERE id=?",
+                   (msg, time.time() + delay, job['id']))
+    else:
+        db.execute("UPDATE ingest_jobs SET status='error', error=?, locked_by=NULL WHERE id=?", (msg, job['id']))
+        db.execute("UPDATE documents SET ingest_status='error' WHERE id=?", (job['document_id'],))
+    db.commit()
+
+def run_ingest_inline(db, doc_id):
+    job = claim_ingest_job(db, 'inline', doc_id)
+    if not job: return
+    try:
+        for kind, fn, args in start_ingest_job(db, job):
+            store_pages(db, doc_id, kind, part_pages(timed_part(fn, args)))
+        complete_ingest_job(db, job)
+    except Exception as e:
+        # không có worker để thử lại -> đánh dấu lỗi ngay
+        fail_ingest_job(db, dict(job, attempts=job['max_attempts']), e)
+        return
+    run_summaries(db, doc_id)
+
+def run_ingest_worker(db, processes, once=False, poll=1.0):
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    done_count = 0
+    threads = ThreadPoolExecutor(max_workers=app.config['SUMMARY_CONCURRENCY'])
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        inflight = {}  # future -> (trạng thái việc, kind)
+        summaries = {}  # future -> (bộ tóm tắt, lô, hạn chót); gọi mạng nên chạy trên luồng
+        while True:
+            while len(inflight) < processes:
+                job = claim_ingest_job(db, worker)
+                if not job: break
+                try:
+                    parts = start_ingest_job(db, job)
+                except Exception as e:
+                    fail_ingest_job(db, job, e); continue
+                if not parts:
+                    complete_ingest_job(db, job); done_count += 1; continue
+                state = {'job': job, 'left': len(parts), 'error': None}
+                for kind, fn, args in parts:
+                    inflight[pool.submit(timed_part, fn, args)] = (state, kind)
+            try: submit_summaries(db, threads, summaries)
+            except Exception as e: app.logger.warning("summary: %s", e)
+            if not inflight and not summaries:
+                if once:
+                    threads.shutdown(wait=False, cancel_futures=True)
+                    return done_count
+                time.sleep(poll); continue
+            finished, _ = wait(list(inflight) + list(summaries), timeout=poll, return_when=FIRST_COMPLETED)
+            collect_summaries(db, summaries, [f for f in finished if f in summaries])
+            for fut in finished:
+                if fut not in inflight: continue
+                state, kind = inflight.pop(fut)
+                job = state['job']
+                state['left'] -= 1
+                if state['error'] is None:
+                    try: store_pages(db, job['document_id'], kind, part_pages(fut.result()))
+                    except Exception as e: state['error'] = e
+                if state['left']: continue
+                if state['error'] is None:
+                    complete_ingest_job(db, job); done_count += 1
+                    app.logger.info("ingest: tài liệu %s xong (lần %s)", job['document_id'], job['attempts'])
+                else:
+                    fail_ingest_job(db, job, state['error'])
+                    app.logger.warning("ingest: tài liệu %s lỗi lần %s: %s",
+                                       job['document_id'], job['attempts'], state['error'])
+
+# ---------- bulk import ----------
+# `flask import-docs`: lưu tệp vào blob store, trích xuất song song trên pool tiến trình (lô sau được trích
+# xuất trong lúc lô trước đang ghi), rồi ghi cả lô bằng executemany trong một giao dịch.
+IMPORT_ALIASES = {
+    'file': 'original_file', 'original': 'original_file', 'translated': 'translated_file',
+    'agency': 'authoring_agency', 'date': 'creation_date',
+    'confidentiality': 'confidentiality_level', 'urgency': 'urgency_level',
+    'summary': 'main_content', 'handler_id': 'handler',
+}
+
+def read_manifest(directory, path=None):
+    if not path:
+        return [{'original_file': n, 'title': os.path.splitext(n)[0]} for n in sorted(os.listdir(directory))
+                if n.lower().endswith(('.pdf', '.docx'))]
+    with open(path, encoding='utf-8-sig', newline='') as fh:
+        if path.lower().endswith('.csv'):
+            rows = list(csv.DictReader(fh))
+        else:
+            text = fh.read()
+            rows = json.loads(text) if text.lstrip().startswith('[') else \
+                [json.loads(line) for line in text.splitlines() if line.strip()]
+    out = []
+    for i, r in enumerate(rows, 1):
+        r = {IMPORT_ALIASES.get(k.strip().lower(), k.strip().lower()): (v.strip() if isinstance(v, str) else v)
+             for k, v in r.items() if k}
+        if not r.get('title'): r['title'] = os.path.splitext(os.path.basename(r.get('original_file') or ''))[0]
+        r['_source'] = f"{os.path.basename(path)}#{i}"
+        out.append(r)
+    return out
+
+def import_key(row):
+    # theo cặp tệp: chạy lại (kể cả với manifest khác) bỏ qua tệp đã nhập; dòng chỉ có metadata không có tệp
+    # để nhận diện nên dùng tên manifest + số thứ tự dòng
+    if row.get('original_file') or row.get('translated_file'):
+        return f"{row.get('original_file') or ''}|{row.get('translated_file') or ''}"
+    return row.get('_source') or '|'
+
+def _import_handler(users, value):
+    if value in (None, '', 'null'): return None
+    value = str(value).strip()
+    if value.isdigit() and int(value) in users['by_id']: return int(value)
+    for u in users['by_name']:
+        if value.lower() in (u['username'].lower(), u['full_name'].lower()): return u['id']
+    return None
+
+def _import_prepare(db, pool, directory, rows, stats, echo):
+    # lưu tệp + gửi việc trích xuất; trả về các mục chờ ghi
+    items, chunk = [], app.config['EXTRACT_CHUNK_PAGES']
+    for row in rows:
+        item = {'row': row, 'files': {}, 'parts': {}}
+        for kind in PAGE_KINDS:
+            name = row.get(f'{kind}_file')
+            if not name: continue
+            src = os.path.join(directory, name)
+            if not os.path.isfile(src):
+                echo(f"bỏ qua {import_key(row)}: không thấy {name}"); stats['missing'] += 1; item = None; break
+            with open(src, 'rb') as fh: rel = store_blob(db, fh, name)
+            stats['bytes'] += os.path.getsize(src)
+            item['files'][kind] = (rel, os.path.basename(name))
+            item['parts'][kind] = [pool.submit(timed_part, fn, args) for fn, args in extraction_plan(upload_abs(rel), chunk)]
+        if item: items.append(item)
+    db.commit()  # blob mồ côi nếu bị ngắt trước khi ghi tài liệu -> `flask gc-blobs`
+    return items
+
+def _import_commit(db, items, users, stats):
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        # cấp id trước để ghi cả lô bằng executemany (đang giữ khóa ghi nên không tranh chấp)
+        next_id = db.execute("""
+            SELECT MAX(COALESCE((SELECT MAX(id) FROM documents), 0),
+                       COALESCE((SELECT seq FROM sqlite_sequence WHERE name='documents'), 0))
+        """).fetchone()[0] + 1
+        docs, contents, pages, log, ready, retry = [], [], [], [], [], []
+        for doc_id, item in enumerate(items, next_id):
+            row, files = item['row'], item['files']
+            handler_id = _import_handler(users, row.get('handler'))
+            extractable = any(item['parts'].values())
+            failed = False
+            for kind, futs in item['parts'].items():
+                try:
+                    pages += [(doc_id, kind, no, pack_text(text)) for f in futs for no, text in part_pages(f.result())]
+                except Exception:
+                    failed = True  # để worker thử lại theo cơ chế thường
+            summary = row.get('main_content') or None
+            docs.append((doc_id, row['title'], row.get('authoring_agency'), row.get('country'),
+                         canonical_dt(row.get('creation_date')), row.get('source_type'),
+                         row.get('confidentiality_level'), row.get('urgency_level'),
+                         *[files.get(k, (None, None))[0] for k in PAGE_KINDS],
+                         *[files.get(k, (None, None))[1] for k in PAGE_KINDS],
+                         handler_id, 'Đang xử lý' if handler_id else 'Chưa xử lý',
+                         row.get('week_number') or None, row.get('year_number') or None, row.get('notes'),
+                         'extracting' if extractable else 'ready'))
+            contents.append((doc_id, pack_text(summary if extractable else (summary or EMPTY_SUMMARY)),
+                             'pending' if extractable and not summary and not failed else 'ready'))
+            log.append((import_key(row), doc_id))
+            if failed: retry.append((doc_id, 0 if summary else 1, app.config['INGEST_MAX_ATTEMPTS']))
+            elif extractable: ready.append((doc_id,))
+        db.executemany("""
+            INSERT INTO documents (
+                id, title, authoring_agency, country, creation_date,
+                source_type, confidentiality_level, urgency_level,
+                original_file_path, translated_file_path, original_file_name, translated_file_name,
+                handler_id, status, week_number, year_number, notes, ingest_status
+            ) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+        """, docs)
+        db.executemany("INSERT INTO document_contents (document_id, main_content_summary, summary_status) VALUES (?,?,?)",
+                       contents)
+        db.executemany("INSERT OR REPLACE INTO document_pages (document_id, kind, page_no, text) VALUES (?,?,?,?)", pages)
+        db.executemany("INSERT INTO import_log (source_key, document_id) VALUES (?,?)", log)
+        # trang đã ghi xong -> chuyển 'ready' để trigger đưa văn bản vào chỉ mục FTS một lần
+        db.executemany("UPDATE documents SET ingest_status='ready' WHERE id=?", ready)
+        db.executemany("INSERT INTO ingest_jobs (document_id, summarize, max_attempts) VALUES (?,?,?)", retry)
+        db.commit()
+    except Exception:
+        db.rollback(); raise
+    stats['docs'] += len(docs); stats['pages'] += len(pages); stats['retry'] += len(retry)
+
+def import_documents(db, directory, rows, processes, batch_size, echo=print):
+    done = {r[0] for r in db.execute("SELECT source_key FROM import_log")}
+    todo, seen, duplicate = [], set(), 0
+    for r in rows:
+        key = import_key(r)
+        if key in done: continue
+        if key in seen:  # source_key là UNIQUE: dòng trùng sẽ làm hỏng cả lô
+            echo(f"bỏ qua {r.get('_source') or key}: trùng {key} với dòng trước"); duplicate += 1; continue
+        seen.add(key); todo.append(r)
+    stats = {'docs': 0, 'pages': 0, 'bytes': 0, 'missing': 0, 'retry': 0, 'duplicate': duplicate,
+             'skipped': len(rows) - len(todo) - duplicate}
+    users = user_directory(db)
+    started = time.monotonic()
+    def progress():
+        el = max(time.monotonic() - started, 1e-6)
+        echo(f"{stats['docs']}/{len(todo)} tài liệu, {stats['pages']} trang — "
+             f"{stats['docs'] / el:.1f} tài liệu/s, {stats['bytes'] / 1e6 / el:.1f} MB/s")
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        pending = None
+        for i in range(0, len(todo), batch_size):
+            batch = _import_prepare(db, pool, directory, todo[i:i + batch_size], stats, echo)
+            if pending is not None:
+                _import_commit(db, pending, users, stats); progress()
+            pending = batch
+        if pending:
+            _import_commit(db, pending, users, stats); progress()
+    stats['seconds'] = time.monotonic() - started
+    return stats
+
+# ---------- dashboard filters ----------
+def parse_filters(args):
     q = (args.get('q') or '').strip()
     country = (args.get('country') or '').strip()
     status = (args.get('status') or '').strip()
@@ -156,52 +2003,295 @@ def dashboard():
     if year_raw != "":
         try: year = f"{int(year_raw):04d}"
         except ValueError: year = ""
+    return {"q": q, "country": country, "status": status,
+            "week": week, "year": year, "handler_id": handler_raw}
 
+def filter_sql(filters):
+    # mọi điều kiện đều khớp được chỉ mục (xem `flask db check-plans`)
+    cond, prm = [], []
+    match = fts_query(filters['q']) if filters['q'] else ""
+    join = "JOIN documents_fts ON documents_fts.rowid = d.id" if match else ""
+    if match: cond.append("documents_fts MATCH ?"); prm.append(match)
+    if filters['country']:
+        cond.append("d.country = ? COLLATE NOCASE"); prm.append(filters['country'])
+    if filters['status']: cond.append("d.status = ?"); prm.append(filters['status'])
+    if filters['year']: cond.append("d.creation_year = ?"); prm.append(int(filters['year']))
+    if filters['week']: cond.append("d.creation_week = ?"); prm.append(int(filters['week']))
+    handler_raw = filters['handler_id']
+    if handler_raw == 'null':
+        cond.append("d.handler_id IS NULL")
+    elif handler_raw:
+        try: handler_id = int(handler_raw)
+        except ValueError: raise ValueError(f"handler_id không hợp lệ: {handler_raw!r}") from None
+        cond.append("d.handler_id = ?"); prm.append(handler_id)
+    return join, cond, prm
+
+# bộ lọc có số đếm -> cột tương ứng; số đếm của mỗi bộ lọc tính theo các bộ lọc KHÁC (chọn giá trị khác sẽ ra bao nhiêu)
+FACETS = (('status', 'status'), ('country', 'country'), ('handler_id', 'handler_id'), ('year', 'creation_year'))
+NOCASE = str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ', 'abcdefghijklmnopqrstuvwxyz')  # như COLLATE NOCASE: chỉ ASCII
+
+def facet_counts(db, filters):
+    # một truy vấn gộp: nhóm theo 4 cột (q và tuần áp dụng cho mọi số đếm), cờ m_<bộ lọc>: nhóm có khớp bộ lọc đó
+    empty = {k: '' for k in filters}
+    join, cond, prm = filter_sql(dict(filters, **{f: '' for f, _ in FACETS}))
+    flags, fprm = [], []
+    for f, _ in FACETS:
+        _, c, p = filter_sql(dict(empty, **{f: filters[f]}))
+        flags.append(f"{' AND '.join(c) or '1'} AS m_{f}"); fprm += p
+    if join or filters['week']:
+        src, n = f"documents d {join}", "COUNT(*)"  # tìm kiếm/lọc tuần: chỉ quét các tài liệu khớp
+    else:
+        src, n = """(SELECT NULLIF(status, '') AS status, NULLIF(country, '') AS country, NULLIF(handler_id, 0) AS handler_id,
+                            NULLIF(creation_year, 0) AS creation_year, n FROM document_facets) d""", "SUM(d.n)"
+    where = "WHERE " + " AND ".join(cond) if cond else ""
+    rows = db.execute(f"""
+        SELECT {", ".join(f"d.{col} AS {f}" for f, col in FACETS)}, {n} AS n, {", ".join(flags)}
+        FROM {src} {where}
+        GROUP BY d.status, d.country COLLATE NOCASE, d.handler_id, d.creation_year
+    """, (*fprm, *prm)).fetchall()
+    counts, names = {f: {} for f, _ in FACETS}, {}
+    k = len(FACETS)
+    for r in rows:
+        # nhóm lệch đúng một bộ lọc chỉ tính cho bộ lọc đó, lệch từ hai trở lên thì bỏ
+        miss = [i for i in range(k) if not r[k + 1 + i]]
+        if len(miss) > 1: continue
+        for i in miss or range(k):
+            f, v = FACETS[i][0], r[i]
+            if f == 'handler_id': v = 'null' if v is None else v
+            elif v is None: continue
+            elif f == 'country': v = names.setdefault(v.translate(NOCASE), v)
+            counts[f][v] = counts[f].get(v, 0) + r[k]
+    return counts
+
+# ---------- export ----------
+# Xuất danh sách đã lọc theo luồng: đọc con trỏ SQLite theo lô và trả từng phần ngay khi có,
+# bộ nhớ không phụ thuộc số dòng. XLSX được ghi trực tiếp (zip không cần seek, chuỗi inline).
+EXPORT_COLUMNS = [
+    ('id', 'ID'), ('title', 'Tiêu đề'), ('authoring_agency', 'Cơ quan soạn thảo'), ('country', 'Hướng'),
+    ('creation_date', 'Thời gian soạn thảo'), ('source_type', 'Nguồn'), ('confidentiality_level', 'Độ mật'),
+    ('urgency_level', 'Độ khẩn'), ('status', 'Trạng thái'), ('handler_name', 'Người xử lý'),
+    ('completion_time', 'Thời gian hoàn thành'), ('created_at', 'Ngày tạo'), ('notes', 'Ghi chú'),
+    ('main_content_summary', 'Nội dung chính'),
+]
+EXPORT_FETCH = 500
+
+def export_rows(db, filters):
+    # truy vấn chạy ngay khi gọi (bộ lọc sai -> lỗi trước khi gửi header), chỉ việc đọc từng lô là lười
+    join, cond, prm = filter_sql(filters)
+    where = "WHERE " + " AND ".join(cond) if cond else ""
+    cols = ", ".join(f"unz(c.{k}) AS {k}" if k == 'main_content_summary' else f"d.{k}"
+                     for k, _ in EXPORT_COLUMNS if k != 'handler_name')
+    cur = db.execute(f"""
+        SELECT {cols}, d.handler_id FROM documents d {join}
+        LEFT JOIN document_contents c ON c.document_id = d.id
+        {where} ORDER BY d.created_at DESC, d.id DESC
+    """, prm)
+    by_id = user_directory(db)['by_id']
+    def batches():
+        while True:
+            batch = cur.fetchmany(EXPORT_FETCH)
+            if not batch: return
+            out = []
+            for r in batch:
+                u = by_id.get(r['handler_id'])
+                out.append([(u['full_name'] if u else None) if k == 'handler_name' else r[k] for k, _ in EXPORT_COLUMNS])
+            yield out
+    return batches()
+
+def _cell(v):
+    return "" if v is None else str(v)
+
+def export_csv(batches):
+    buf = io.StringIO()
+    w = csv.writer(buf)
+    w.writerow([label for _, label in EXPORT_COLUMNS])
+    yield ("\ufeff" + buf.getvalue()).encode('utf-8')  # BOM để Excel nhận UTF-8
+    for batch in batches:
+        buf.seek(0); buf.truncate()
+        w.writerows([[_cell(v) for v in row] for row in batch])
+        yield buf.getvalue().encode('utf-8')
+
+def export_jsonl(batches):
+    keys = [k for k, _ in EXPORT_COLUMNS]
+    for batch in batches:
+        yield "".join(json.dumps(dict(zip(keys, row)), ensure_ascii=False, default=str) + "\n"
+                      for row in batch).encode('utf-8')
+
+class _ZipStream:
+    # đích ghi chỉ có write/tell (không seek) -> zipfile ghi kiểu luồng với data descriptor
+    def __init__(self): self.parts, self.pos = [], 0
+    def write(self, b): self.parts.append(bytes(b)); self.pos += len(b); return len(b)
+    def tell(self): return self.pos
+    def flush(self): pass
+    def drain(self):
+        out = b"".join(self.parts); self.parts.clear(); return out
+
+_XML_BAD = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+def _xlsx_row(n, values):
+    cells = []
+    for i, v in enumerate(values):
+        ref = f"{chr(65 + i) if i < 26 else 'A' + chr(65 + i - 26)}{n}"
+        if isinstance(v, (int, float)) and not isinstance(v, bool):
+            cells.append(f'<c r="{ref}"><v>{v}</v></c>')
+        elif v is not None:
+            text = escape(_XML_BAD.sub("", str(v)))
+            cells.append(f'<c r="{ref}" t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>')
+    return f'<row r="{n}">{"".join(cells)}</row>'
+
+XLSX_PARTS = {
+    '[Content_Types].xml': '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>',
+    '_rels/.rels': '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+        '</Relationships>',
+    'xl/workbook.xml': '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="Tài liệu" sheetId="1" r:id="rId1"/></sheets></workbook>',
+    'xl/_rels/workbook.xml.rels': '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+        '</Relationships>',
+}
+
+def export_xlsx(batches):
+    out = _ZipStream()
+    with zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for name, xml in XLSX_PARTS.items(): zf.writestr(name, xml)
+        with zf.open('xl/worksheets/sheet1.xml', 'w', force_zip64=True) as sheet:
+            sheet.write(b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                        b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>')
+            sheet.write(_xlsx_row(1, [label for _, label in EXPORT_COLUMNS]).encode('utf-8'))
+            n = 1
+            yield out.drain()
+            for batch in batches:
+                rows = []
+                for row in batch:
+                    n += 1; rows.append(_xlsx_row(n, row))
+                sheet.write("".join(rows).encode('utf-8'))
+                yield out.drain()
+            sheet.write(b'</sheetData></worksheet>')
+    yield out.drain()
+
+EXPORT_FORMATS = {
+    'csv': (export_csv, 'text/csv'),
+    'jsonl': (export_jsonl, 'application/x-ndjson'),
+    'xlsx': (export_xlsx, 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+}
+
+# ---------- routes ----------
+# chỉ các cột mà danh sách hiển thị; văn bản đầy đủ nằm ở document_contents
+LIST_COLUMNS = """
+    d.id, d.title, d.authoring_agency, d.creation_date, d.country, d.handler_id,
+    d.completion_time, d.status, d.created_at, d.ingest_status, d.original_file_path,
+    c.summary_preview
+"""
+
+def list_select(join="", extra=""):
+    return f"""
+        SELECT {LIST_COLUMNS} {extra}
+        FROM documents d
+        {join}
+        LEFT JOIN document_contents c ON c.document_id=d.id
+    """
+
+def keyset_page_sql(cond, prm, key=None, backward=False, select=None):
+    # trả về (sql, tham số); tham số cuối cùng (LIMIT) do nơi gọi thêm vào
+    cond, prm = list(cond), list(prm)
+    if key:
+        cond.append(f"(d.created_at, d.id) {'>' if backward else '<'} (?, ?)"); prm += key
+    where = "WHERE " + " AND ".join(cond) if cond else ""
+    direction = "ASC" if backward else "DESC"
+    return f"""{select or list_select()} {where}
+        ORDER BY d.created_at {direction}, d.id {direction} LIMIT ?
+    """, prm
+
+@app.route('/')
+@login_required
+def dashboard():
+    db = get_db()
+    args = request.args
+    filters = parse_filters(args)
+    try: filter_sql(filters)
+    except ValueError as e: abort(400, str(e))
     try: page_size = int(args.get('page_size', 10))
     except ValueError: page_size = 10
     if page_size not in [5,10,20,50,100]: page_size = 10
     try: page = int(args.get('page', 1))
     except ValueError: page = 1
     if page < 1: page = 1
+    filters['page_size'] = page_size
+    # phân trang theo con trỏ: ?after=<con trỏ dòng cuối> / ?before=<con trỏ dòng đầu>
+    backward = bool(args.get('before'))
+    token = args.get('before') if backward else args.get('after')
+    versions = current_versions(db)  # đọc trước khi truy vấn: kết quả luôn mới ít nhất bằng phiên bản này
 
-    cond, prm = [], []
-    if q:       cond.append("d.title LIKE ?"); prm.append(f"%{q}%")
-    if country: cond.append("d.country LIKE ?"); prm.append(f"%{country}%")
-    if status:  cond.append("d.status = ?"); prm.append(status)
-    if week:    cond.append("strftime('%W', d.creation_date) = ?"); prm.append(week)
-    if year:    cond.append("strftime('%Y', d.creation_date) = ?"); prm.append(year)
-    if handler_raw == 'null':
-        cond.append("d.handler_id IS NULL")
-    elif handler_raw:
-        cond.append("d.handler_id = ?"); prm.append(int(handler_raw))
-    where = "WHERE " + " AND ".join(cond) if cond else ""
+    def build():
+        row = db.execute("SELECT total, processing, completed, unassigned FROM document_stats WHERE id = 1").fetchone()
+        stats = dict(row) if row else {"total": 0, "processing": 0, "completed": 0, "unassigned": 0}
+        join, cond, prm = filter_sql(filters)
+        match = bool(join)
+        where = "WHERE " + " AND ".join(cond) if cond else ""
 
-    total_filtered = get_db().execute(f"SELECT COUNT(d.id) FROM documents d {where}", prm).fetchone()[0]
-    total_pages = max((total_filtered + page_size - 1) // page_size, 1)
-    if page > total_pages: page = total_pages
-    offset = (page - 1) * page_size
+        total_filtered = cached_count(db, f"SELECT COUNT(d.id) FROM documents d {join} {where}", prm,
+                                      versions.get('documents'))
+        cursor = decode_cursor(token) or {}
+        if match:
+            # kết quả tìm kiếm xếp theo bm25, không có khóa ổn định để seek -> con trỏ mang offset
+            offset = int(cursor.get('o', 0))
+            if backward: offset = max(offset - page_size, 0)
+            extra = f", snippet(documents_fts, -1, '{SNIPPET_OPEN}', '{SNIPPET_CLOSE}', '…', 16) AS snippet"
+            order = f"bm25(documents_fts, {', '.join(map(str, FTS_WEIGHTS))}), d.created_at DESC"
+            rows = db.execute(f"{list_select(join, extra)} {where} ORDER BY {order} LIMIT ? OFFSET ?",
+                              (*prm, page_size + 1, offset)).fetchall()
+            has_next, rows = len(rows) > page_size, rows[:page_size]
+            has_prev = offset > 0
+            first_cursor, last_cursor = {'o': offset}, {'o': offset + len(rows)}
+        else:
+            key = cursor.get('k')
+            sql, kprm = keyset_page_sql(cond, prm, key, backward)
+            rows = db.execute(sql, (*kprm, page_size + 1)).fetchall()
+            more, rows = len(rows) > page_size, rows[:page_size]
+            if backward:
+                rows.reverse(); has_prev, has_next = more, True
+            else:
+                has_prev, has_next = bool(key), more
+            first_cursor = rows and {'k': [str(rows[0]['created_at']), rows[0]['id']]}
+            last_cursor = rows and {'k': [str(rows[-1]['created_at']), rows[-1]['id']]}
+        return dict(
+            stats=stats, documents=resolve_handlers(db, make_dicts(rows)),
+            total_filtered=total_filtered, total_pages=max((total_filtered + page_size - 1) // page_size, 1),
+            page=page if has_prev else 1,
+            prev_cursor=encode_cursor(first_cursor) if has_prev and rows else None,
+            next_cursor=encode_cursor(last_cursor) if has_next and rows else None,
+            facets=facet_counts(db, filters),
+        )
 
-    rows = db.execute(f"""
-        SELECT d.*, u.full_name AS handler_name
-        FROM documents d
-        LEFT JOIN users u ON d.handler_id=u.id
-        {where}
-        ORDER BY d.created_at DESC
-        LIMIT ? OFFSET ?
-    """, (*prm, page_size, offset)).fetchall()
-
-    users = make_dicts(db.execute("SELECT id, full_name FROM users ORDER BY full_name").fetchall())
-    filters = {
-        "q": q, "country": country, "status": status,
-        "week": week, "year": year, "page_size": page_size,
-        "handler_id": handler_raw,
-    }
-    return render_template(
-        'index.html',
-        stats=stats, documents=make_dicts(rows), users=users,
-        current_user=session, active_page='documents',
-        total_filtered=total_filtered, total_pages=total_pages, page=page, filters=filters
-    )
+    ctx = cached_view('dashboard', [versions, filters, page, backward, token], build)
+    return render_template('index.html', users=handler_choices(db), current_user=session, active_page='documents',
+                           filters=filters, **ctx)
+
+@app.route('/documents/export.<fmt>')
+@login_required
+def export_documents(fmt):
+    # cùng bộ lọc với dashboard (q, country, status, week, year, handler_id)
+    if fmt not in EXPORT_FORMATS: abort(404)
+    writer, mimetype = EXPORT_FORMATS[fmt]
+    try: batches = export_rows(get_db(), parse_filters(request.args))
+    except ValueError as e: abort(400, str(e))
+    resp = Response(stream_with_context(writer(batches)), mimetype=mimetype)
+    name = f"tai-lieu-{datetime.now().strftime('%Y%m%d-%H%M')}.{fmt}"
+    resp.headers['Content-Disposition'] = f'attachment; filename="{name}"'
+    resp.headers['X-Accel-Buffering'] = 'no'  # nginx: gửi ngay, không gom cả phản hồi
+    resp.cache_control.no_store = True
+    return resp
 
 @app.route('/profile', methods=['GET', 'POST'])
 @login_required
@@ -216,18 +2306,15 @@ def profile():
         confirm   = request.form.get('confirm_password','').strip()
         avatar_f  = request.files.get('avatar')
 
-        # xử lý avatar
-        avatar_rel = None
+        # xử lý avatar: giải mã và tạo các cỡ nhỏ, không lưu tệp gốc
+        avatar_rel = old_avatar = None
         if avatar_f and avatar_f.filename:
-            os.makedirs(os.path.join(app.config['UPLOAD_FOLDER'], 'avatars'), exist_ok=True)
-            fn = unique_secure_filename(avatar_f.filename)
-            avatar_rel = os.path.join('avatars', fn)
-            avatar_abs = os.path.join(app.config['UPLOAD_FOLDER'], avatar_rel)
-            avatar_f.save(avatar_abs)
-
-            old = db.execute("SELECT avatar FROM users WHERE id=?", (uid,)).fetchone()
-            if old and old['avatar']:
-                delete_file_safe(os.path.join(app.config['UPLOAD_FOLDER'], old['avatar']))
+            try:
+                avatar_rel = save_avatar(avatar_f.read(app.config['AVATAR_MAX_BYTES'] + 1))
+            except Exception as e:
+                flash(f'Ảnh đại diện không hợp lệ ({e}).', 'error')
+                return redirect(url_for('profile'))
+            old_avatar = db.execute("SELECT avatar FROM users WHERE id=?", (uid,)).fetchone()['avatar']
 
         # đổi mật khẩu (nếu có nhập)
         if new_pw or confirm:
@@ -244,6 +2331,7 @@ def profile():
                 WHERE id=?
             """, (full_name, position, avatar_rel, uid))
         db.commit()
+        if old_avatar != avatar_rel: release_avatar(db, old_avatar)
 
         session['user_name'] = full_name
         if avatar_rel: session['avatar'] = avatar_rel
@@ -261,7 +2349,8 @@ def manage_users():
         flash('Bạn không có quyền truy cập trang này.', 'error')
         return redirect(url_for('dashboard'))
     db = get_db()
-    users = make_dicts(db.execute("SELECT id, username, full_name, role, position FROM users ORDER BY id ASC").fetchall())
+    users = [{k: u[k] for k in ('id', 'username', 'full_name', 'role', 'position')}
+             for u in sorted(user_directory(db)['by_id'].values(), key=lambda u: u['id'])]
     return render_template('users.html', users=users, current_user=session, active_page='users')
 
 @app.route('/login', methods=['GET','POST'])
@@ -291,23 +2380,173 @@ def logout():
 def view_document(doc_id):
     edit_mode = request.args.get('edit','false').lower()=='true'
     db = get_db()
-    row = db.execute("""
-        SELECT d.*, u.full_name AS handler_name
-        FROM documents d
-        LEFT JOIN users u ON d.handler_id=u.id
-        WHERE d.id=?
-    """, (doc_id,)).fetchone()
-    if not row:
+    head = db.execute("SELECT row_version, ingest_status FROM documents WHERE id=?", (doc_id,)).fetchone()
+    if not head:
         flash('Không tìm thấy tài liệu.', 'error')
         return redirect(url_for('dashboard'))
-    users = make_dicts(db.execute("SELECT id, full_name FROM users ORDER BY full_name").fetchall())
-    return render_template('viewer.html', doc=dict(row), users=users,
+
+    def build():
+        row = db.execute("""
+            SELECT d.*, unz(c.main_content_summary) AS main_content_summary, c.summary_status, c.summary_error
+            FROM documents d
+            LEFT JOIN document_contents c ON c.document_id=d.id
+            WHERE d.id=?
+        """, (doc_id,)).fetchone()
+        ingest_job = None
+        if row['ingest_status'] == 'error':
+            ingest_job = db.execute("SELECT error FROM ingest_jobs WHERE document_id=? ORDER BY id DESC LIMIT 1",
+                                    (doc_id,)).fetchone()
+        page_counts = {r[0]: r[1] for r in db.execute(
+            "SELECT kind, COUNT(*) FROM document_pages WHERE document_id=? GROUP BY kind", (doc_id,))}
+        render_pages = {k: render_page_count(row[f'{k}_file_path']) for k in PAGE_KINDS
+                        if renderable(row[f'{k}_file_path'])}
+        return dict(doc=resolve_handlers(db, [dict(row)])[0], ingest_job=ingest_job and dict(ingest_job),
+                    page_counts=page_counts, render_pages=render_pages)
+
+    # row_version tăng ở mọi thay đổi của tài liệu/tóm tắt; trang đang trích xuất thay đổi liên tục -> không cache
+    if head['ingest_status'] == 'extracting': ctx = build()
+    else: ctx = cached_view('viewer', [doc_id, head['row_version'], data_version(db, 'users')], build)
+    return render_template('viewer.html', users=handler_choices(db), **ctx,
                            current_user=session, edit_mode=edit_mode, active_page='documents')
 
+@app.route('/documents/<int:doc_id>/ingest-status')
+@login_required
+def ingest_status(doc_id):
+    db = get_db()
+    doc = db.execute("""
+        SELECT d.ingest_status, c.summary_status FROM documents d
+        LEFT JOIN document_contents c ON c.document_id = d.id WHERE d.id=?
+    """, (doc_id,)).fetchone()
+    if not doc: return {"error": "not found"}, 404
+    job = db.execute("""
+        SELECT status, attempts, max_attempts, error FROM ingest_jobs
+        WHERE document_id=? ORDER BY id DESC LIMIT 1
+    """, (doc_id,)).fetchone()
+    return {"ingest_status": doc['ingest_status'], "summary_status": doc['summary_status'],
+            "job": dict(job) if job else None}
+
+@app.route('/documents/<int:doc_id>/pages')
+@login_required
+def document_pages(doc_id):
+    # tải văn bản trích xuất theo từng lô trang cho trình xem
+    kind = request.args.get('kind', 'original')
+    if kind not in PAGE_KINDS: return {"error": "kind"}, 400
+    try:
+        start = max(int(request.args.get('start', 1)), 1)
+        limit = min(max(int(request.args.get('limit', 10)), 1), 50)
+    except ValueError:
+        return {"error": "start/limit"}, 400
+    db = get_db()
+    total = db.execute("SELECT MAX(page_no) FROM document_pages WHERE document_id=? AND kind=?",
+                       (doc_id, kind)).fetchone()[0] or 0
+    rows = db.execute("""
+        SELECT page_no, text FROM document_pages
+        WHERE document_id=? AND kind=? AND page_no >= ? ORDER BY page_no LIMIT ?
+    """, (doc_id, kind, start, limit)).fetchall()
+    pages = [{"page_no": r['page_no'], "text": unpack_text(r['text']) or ""} for r in rows]
+    nxt = pages[-1]['page_no'] + 1 if pages and pages[-1]['page_no'] < total else None
+    return {"kind": kind, "total": total, "pages": pages, "next": nxt}
+
+@app.route('/documents/<int:doc_id>/pages/search')
+@login_required
+def search_document_pages(doc_id):
+    kind = request.args.get('kind', 'original')
+    q = (request.args.get('q') or '').strip()
+    if kind not in PAGE_KINDS or not q: return {"kind": kind, "q": q, "hits": []}
+    hits, needle = [], q.lower()
+    # văn bản trang có thể đã nén -> giải nén và tìm trong Python (lower() Unicode đầy đủ, SQLite chỉ ASCII)
+    for r in get_db().execute("SELECT page_no, text FROM document_pages WHERE document_id=? AND kind=? ORDER BY page_no",
+                              (doc_id, kind)):
+        text = unpack_text(r['text']) or ""
+        pos = text.lower().find(needle)
+        if pos < 0: continue
+        hits.append({"page_no": r['page_no'], "excerpt": text[max(pos - 60, 0):pos + len(q) + 60].replace("\n", " ")})
+        if len(hits) >= 200: break
+    return {"kind": kind, "q": q, "hits": hits}
+
+@app.route('/documents/<int:doc_id>/render/<kind>')
+@login_required
+def render_document_page(doc_id, kind):
+    # ảnh một trang của tệp gốc/bản dịch; ?v=<phiên bản tệp> cho phép trình duyệt cache vĩnh viễn
+    size = request.args.get('size', 'md')
+    try: page_no = int(request.args.get('page', 1))
+    except ValueError: abort(400)
+    if kind not in PAGE_KINDS or size not in RENDER_SIZES: abort(400)
+    row = get_db().execute("SELECT original_file_path, translated_file_path FROM documents WHERE id=?",
+                           (doc_id,)).fetchone()
+    p = row[f'{kind}_file_path'] if row else None
+    version = file_version(p) if renderable(p) else None
+    if not version: abort(404)
+    try: out = render_page(p, version, page_no, size)
+    except Exception: abort(404)  # tệp hỏng / không đọc được
+    if not out: abort(404)
+    resp = send_file(out, mimetype='image/jpeg', conditional=True, etag=f"{version}-{page_no}-{size}", max_age=0)
+    return versioned_cache(resp, version)
+
+@app.route('/documents/<int:doc_id>/preview/<kind>')
+@login_required
+def preview_document(doc_id, kind):
+    # bản xem trước HTML của tệp DOCX; gửi nguyên bản nén nếu trình duyệt nhận gzip
+    if kind not in PAGE_KINDS: abort(400)
+    row = get_db().execute("SELECT original_file_path, translated_file_path FROM documents WHERE id=?",
+                           (doc_id,)).fetchone()
+    p = row[f'{kind}_file_path'] if row else None
+    version = file_version(p) if p and p.lower().endswith('.docx') else None
+    if not version: abort(404)
+    try: data = docx_preview(p, version)
+    except Exception: abort(404)  # tệp hỏng / không đọc được
+    resp = Response(mimetype='text/html')
+    resp.set_etag(version)
+    resp.vary.add('Accept-Encoding')
+    if 'gzip' in request.accept_encodings:
+        resp.set_data(data); resp.content_encoding = 'gzip'
+    else:
+        resp.set_data(gzip.decompress(data))
+    return versioned_cache(resp.make_conditional(request), version)
+
 @app.route('/uploads/<path:filename>')
 @login_required
 def serve_upload(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    # blob và biến thể ảnh đại diện được đặt tên theo nội dung -> ETag mạnh = tên, nội dung không bao giờ đổi
+    # nên cache lâu dài
+    name = filename.replace('\\', '/')
+    blob_hash = None
+    if name.startswith(BLOB_DIR + '/') or AVATAR_VARIANT_RE.match(name):
+        blob_hash = os.path.splitext(name.rsplit('/', 1)[-1])[0]
+    offload = app.config['UPLOAD_OFFLOAD']
+    if offload:
+        path = safe_join(app.config['UPLOAD_FOLDER'], name)
+        if not path or not os.path.isfile(path): abort(404)
+        resp = Response(mimetype=mimetypes.guess_type(path)[0] or 'application/octet-stream')
+        if offload == 'x-accel':
+            resp.headers['X-Accel-Redirect'] = app.config['UPLOAD_ACCEL_PREFIX'].rstrip('/') + '/' + name
+        else:
+            resp.headers['X-Sendfile'] = path
+        st = os.stat(path)
+        resp.set_etag(blob_hash or f"{int(st.st_mtime)}-{st.st_size}")
+        resp.last_modified = st.st_mtime
+    else:
+        resp = send_from_directory(app.config['UPLOAD_FOLDER'], name, conditional=True,
+                                   etag=blob_hash or True, max_age=0)
+    resp.headers['Accept-Ranges'] = 'bytes'
+    resp.cache_control.private = True
+    if blob_hash:
+        resp.cache_control.no_cache = None
+        resp.cache_control.max_age = 31536000
+        resp.cache_control.immutable = True
+    else:
+        resp.cache_control.no_cache = True
+    if offload:
+        resp = resp.make_conditional(request)
+        if resp.status_code != 200:  # 304/412: proxy vẫn theo X-Accel-Redirect/X-Sendfile và gửi cả tệp nếu còn header
+            resp.headers.pop('X-Accel-Redirect', None); resp.headers.pop('X-Sendfile', None)
+            return resp
+        # proxy tự xử lý Range: chỉ đếm đoạn được yêu cầu (một khoảng), còn lại cả tệp
+        rng = request.range.range_for_length(st.st_size) if request.range else None
+        metric_inc('download_bytes_total', rng[1] - rng[0] if rng else st.st_size, labels=('proxy',))
+    elif resp.status_code in (200, 206):
+        metric_inc('download_bytes_total', resp.content_length or 0, labels=('app',))
+    return resp
 
 # -------- Documents CRUD (giữ như bản trước) --------
 @app.route('/documents/add', methods=['POST'])
@@ -318,7 +2557,7 @@ def add_document():
     title = f['title']
     authoring_agency = f.get('authoring_agency')
     country = f.get('country')
-    draft_time = f.get('creation_date')
+    draft_time = canonical_dt(f.get('creation_date'))
     source_type = f.get('source_type')
     confidentiality_level = f.get('confidentiality_level')
     urgency_level = f.get('urgency_level')
@@ -331,32 +2570,35 @@ def add_document():
     tran = request.files.get('translated_file')
 
     def save_maybe(file):
-        if not file or not file.filename: return None, ""
-        p = os.path.join(app.config['UPLOAD_FOLDER'], secure_filename(file.filename))
-        file.save(p)
-        txt = read_text_from_file(p) if p.lower().endswith(('.pdf','.docx')) else ""
-        return p, txt
+        if not file or not file.filename: return None, None
+        return store_blob(db, file.stream, file.filename), file.filename
 
-    orig_path, orig_txt = save_maybe(orig)
-    tran_path, tran_txt = save_maybe(tran)
+    orig_path, orig_name = save_maybe(orig)
+    tran_path, tran_name = save_maybe(tran)
 
     main_content = f.get('main_content') or ""
     notes = f.get('notes') or ""
-    main_summary = (main_content.strip() or get_summary_from_gemini(tran_txt))
+    main_summary = main_content.strip() or None
+    extractable = [p for p in (orig_path, tran_path) if p and p.lower().endswith(('.pdf','.docx'))]
 
-    db.execute("""
+    cur = db.execute("""
         INSERT INTO documents (
             title, authoring_agency, country, creation_date,
             source_type, confidentiality_level, urgency_level,
-            original_file_path, translated_file_path,
-            original_text, translated_text, main_content_summary,
-            handler_id, status, week_number, year_number, notes
+            original_file_path, translated_file_path, original_file_name, translated_file_name,
+            handler_id, status, week_number, year_number, notes, ingest_status
         ) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
     """, (title, authoring_agency, country, draft_time, source_type, confidentiality_level, urgency_level,
-          orig_path, tran_path, orig_txt, tran_txt, main_summary,
+          orig_path, tran_path, orig_name, tran_name,
           (handler_id if handler_id and handler_id!="null" else None),
-          status, week_number, year_number, notes))
+          status, week_number, year_number, notes, 'extracting' if extractable else 'ready'))
+    doc_id = cur.lastrowid
+    db.execute("INSERT INTO document_contents (document_id, main_content_summary) VALUES (?,?)",
+               (doc_id, pack_text(main_summary if extractable else (main_summary or EMPTY_SUMMARY))))
+    if extractable: enqueue_ingest(db, doc_id, summarize=main_summary is None)
     db.commit()
+    if extractable and not app.config['INGEST_ASYNC']:
+        run_ingest_inline(db, doc_id)
     flash('Thêm tài liệu mới thành công!', 'success')
     return redirect(url_for('dashboard'))
 
@@ -368,22 +2610,49 @@ def edit_document(doc_id):
     f = request.form; db = get_db()
     handler_id = f.get('handler_id') if f.get('handler_id')!='null' else None
     status = f.get('status')
-    completion_time = f.get('completion_time') or None
-    main_content = f.get('main_content') or None
+    completion_time = canonical_dt(f.get('completion_time'))
+    main_content = pack_text(f.get('main_content') or None)
     notes = f.get('notes') or None
-    db.execute("""
+    # sửa có điều kiện theo row_version lúc mở form: người khác đã lưu trước thì không ghi đè
+    seen = f.get('row_version', type=int)
+    if not db.execute("""
         UPDATE documents SET
           title=?, authoring_agency=?, country=?, creation_date=?,
           source_type=?, confidentiality_level=?, urgency_level=?,
-          handler_id=?, status=?, completion_time=?, main_content_summary=?, notes=?
-        WHERE id=?
-    """, (f['title'], f['authoring_agency'], f['country'], f['creation_date'],
+          handler_id=?, status=?, completion_time=?, notes=?, row_version=row_version+1
+        WHERE id=? AND (? IS NULL OR row_version=?)
+    """, (f['title'], f['authoring_agency'], f['country'], canonical_dt(f['creation_date']),
           f['source_type'], f['confidentiality_level'], f['urgency_level'],
-          handler_id, status, completion_time, main_content, notes, doc_id))
+          handler_id, status, completion_time, notes, doc_id, seen, seen)).rowcount:
+        db.rollback()
+        flash('Tài liệu vừa được người khác cập nhật. Vui lòng xem lại và sửa lại.', 'error')
+        return redirect(url_for('view_document', doc_id=doc_id))
+    # không dùng UPSERT: nó kích hoạt cả trigger BEFORE INSERT lẫn BEFORE UPDATE của chỉ mục FTS
+    # nội dung nhập tay thắng bản tóm tắt đang chờ
+    if not db.execute("""
+        UPDATE document_contents SET main_content_summary=?,
+               summary_status=CASE WHEN ? IS NULL THEN summary_status ELSE 'ready' END
+        WHERE document_id=?
+    """, (main_content, main_content, doc_id)).rowcount:
+        db.execute("INSERT INTO document_contents (document_id, main_content_summary) VALUES (?,?)",
+                   (doc_id, main_content))
     db.commit()
     flash('Cập nhật thông tin tài liệu thành công!', 'success')
     return redirect(url_for('view_document', doc_id=doc_id))
 
+@app.route('/documents/<int:doc_id>/summarize', methods=['POST'])
+@login_required
+def summarize_document(doc_id):
+    # nút "Generate": tóm tắt lại từ văn bản bản dịch (lấy từ cache nếu nội dung không đổi)
+    if session.get('user_role') != 'admin':
+        flash('Bạn không có quyền.', 'error'); return redirect(url_for('dashboard'))
+    db = get_db()
+    db.execute("UPDATE document_contents SET main_content_summary=NULL WHERE document_id=?", (doc_id,))
+    queue_summary(db, doc_id)
+    db.commit()
+    if not app.config['INGEST_ASYNC']: run_summaries(db, doc_id)
+    return redirect(url_for('view_document', doc_id=doc_id))
+
 @app.route('/documents/<int:doc_id>/delete', methods=['POST'])
 @login_required
 def delete_document(doc_id):
@@ -391,9 +2660,10 @@ def delete_document(doc_id):
         flash('Bạn không có quyền.', 'error'); return redirect(url_for('dashboard'))
     db = get_db()
     r = db.execute("SELECT original_file_path, translated_file_path FROM documents WHERE id=?", (doc_id,)).fetchone()
-    if r:
-        delete_file_safe(r['original_file_path']); delete_file_safe(r['translated_file_path'])
-    db.execute("DELETE FROM documents WHERE id=?", (doc_id,)); db.commit()
+    db.execute("DELETE FROM documents WHERE id=?", (doc_id,))
+    doomed = release_files(db, [r['original_file_path'], r['translated_file_path']]) if r else []
+    db.commit()
+    for p in doomed: delete_file_safe(p)
     flash('Đã xóa tài liệu thành công.', 'success')
     return redirect(url_for('dashboard'))
 
@@ -404,7 +2674,7 @@ def report_document(doc_id):
     db.execute("""
         UPDATE documents SET status='Đã xử lý', completion_time=?, implementer_id=?
         WHERE id=?
-    """, (datetime.utcnow().isoformat(), session.get('user_id'), doc_id))
+    """, (now_ts(), session.get('user_id'), doc_id))
     db.commit()
     flash('Báo cáo hoàn thành thành công!', 'success')
     return redirect(url_for('view_document', doc_id=doc_id))
@@ -448,6 +2718,437 @@ def edit_user(user_id):
     flash("Cập nhật thông tin người dùng thành công!", "success")
     return redirect(url_for('manage_users'))
 
+# ---------- JSON API ----------
+# /api/v1: cùng phiên đăng nhập và quyền như giao diện web. ?fields=a,b chọn cột trả về (chỉ trong danh sách
+# cho phép). ETag lấy từ row_version; If-None-Match -> 304, If-Match sai -> 412 (ghi có điều kiện trong SQL).
+API_DOC_FIELDS = {
+    'id': 'd.id', 'title': 'd.title', 'authoring_agency': 'd.authoring_agency', 'country': 'd.country',
+    'creation_date': 'd.creation_date', 'source_type': 'd.source_type',
+    'confidentiality_level': 'd.confidentiality_level', 'urgency_level': 'd.urgency_level',
+    'status': 'd.status', 'handler_id': 'd.handler_id', 'handler_name': None, 'implementer_id': 'd.implementer_id',
+    'completion_time': 'd.completion_time', 'created_at': 'd.created_at', 'notes': 'd.notes',
+    'week_number': 'd.week_number', 'year_number': 'd.year_number', 'ingest_status': 'd.ingest_status',
+    'original_file_name': 'd.original_file_name', 'translated_file_name': 'd.translated_file_name',
+    'summary': 'unz(c.main_content_summary)', 'summary_status': 'c.summary_status', 'row_version': 'd.row_version',
+}
+API_DOC_LIST_DEFAULT = ('id', 'title', 'country', 'creation_date', 'status', 'handler_id', 'created_at', 'row_version')
+API_DOC_WRITABLE = ('title', 'authoring_agency', 'country', 'creation_date', 'source_type', 'confidentiality_level',
+                    'urgency_level', 'handler_id', 'status', 'completion_time', 'notes', 'week_number', 'year_number',
+                    'summary')
+API_USER_FIELDS = ('id', 'username', 'full_name', 'position', 'role', 'avatar', 'row_version')
+
+def api_error(status, message):
+    return {"error": message}, status
+
+def api_auth(admin=False):
+    def deco(f):
+        @wraps(f)
+        def inner(*a, **kw):
+            if 'user_id' not in session: return api_error(401, "unauthorized")
+            if admin and session.get('user_role') != 'admin': return api_error(403, "forbidden")
+            return f(*a, **kw)
+        return inner
+    return deco
+
+def api_fields(allowed, default):
+    raw = request.args.get('fields')
+    if not raw: return list(default)
+    fields = [x.strip() for x in raw.split(',') if x.strip()]
+    bad = [x for x in fields if x not in allowed]
+    if bad: abort(400, f"fields không hợp lệ: {', '.join(bad)}")
+    return fields
+
+def api_body(writable):
+    data = request.get_json(silent=True)  # chỉ nhận application/json (form chéo trang không gửi được)
+    if not isinstance(data, dict): abort(400, "cần thân JSON")
+    bad = [k for k in data if k not in writable]
+    if bad: abort(400, f"không sửa được: {', '.join(bad)}")
+    return data
+
+def api_response(payload, etag, status=200):
+    resp = app.response_class(json.dumps(payload, ensure_ascii=False, default=str), status=status,
+                              mimetype='application/json')
+    resp.set_etag(etag)
+    resp.cache_control.private = True
+    resp.cache_control.no_cache = True
+    return resp.make_conditional(request) if request.method == 'GET' else resp
+
+def _fields_tag(fields):
+    return hashlib.sha1(",".join(fields).encode()).hexdigest()[:8]
+
+def api_doc_select(fields, join=""):
+    cols = ", ".join(f"{API_DOC_FIELDS[f]} AS {f}" for f in fields if API_DOC_FIELDS[f])
+    return f"""SELECT {cols}, d.id AS _id, d.row_version AS _rv, d.handler_id AS _handler, d.created_at AS _created
+        FROM documents d {join} LEFT JOIN document_contents c ON c.document_id = d.id"""
+
+def api_doc_rows(db, rows, fields):
+    by_id = user_directory(db)['by_id']
+    out = []
+    for r in rows:
+        item = {f: r[f] for f in fields if API_DOC_FIELDS[f]}
+        if 'handler_name' in fields:
+            u = by_id.get(r['_handler']); item['handler_name'] = u['full_name'] if u else None
+        out.append({f: item[f] for f in fields})
+    return out
+
+def api_fetch_doc(db, doc_id, fields):
+    row = db.execute(f"{api_doc_select(fields)} WHERE d.id=?", (doc_id,)).fetchone()
+    if not row: abort(404)
+    return api_doc_rows(db, [row], fields)[0], f"doc-{row['_id']}-{row['_rv']}-{_fields_tag(fields)}"
+
+def api_if_match(obj_id):
+    # If-Match chứa ETag (doc-<id>-<row_version>-…) hoặc trực tiếp số row_version; None = không ràng buộc,
+    # -1 = không khớp được (ETag của đối tượng khác) -> câu UPDATE có điều kiện sẽ trả 412
+    if not request.if_match or request.if_match.star_tag: return None
+    for tag in request.if_match.as_set():
+        m = re.match(r'^(?:[a-z]+-(\d+)-)?(\d+)(?:-\w+)?$', tag)
+        if m and (m.group(1) is None or int(m.group(1)) == obj_id): return int(m.group(2))
+    return -1
+
+def api_write_doc(db, data, doc_id=None, expected=None):
+    sets = {k: v for k, v in data.items() if k != 'summary'}
+    for k in ('creation_date', 'completion_time'):
+        if k in sets: sets[k] = canonical_dt(sets[k])
+    if doc_id is None:
+        if not (sets.get('title') or '').strip(): abort(400, "thiếu title")
+        sets.setdefault('status', 'Đang xử lý' if sets.get('handler_id') else 'Chưa xử lý')
+        cur = db.execute(f"INSERT INTO documents ({', '.join(sets)}) VALUES ({', '.join('?' * len(sets))})",
+                         list(sets.values()))
+        doc_id = cur.lastrowid
+        db.execute("INSERT INTO document_contents (document_id, main_content_summary) VALUES (?,?)",
+                   (doc_id, pack_text(data.get('summary') or EMPTY_SUMMARY)))
+        return doc_id
+    if sets or expected is not None:
+        assign = ", ".join([f"{k}=?" for k in sets] + ["row_version = row_version + 1"])
+        sql = f"UPDATE documents SET {assign} WHERE id=?" + (" AND row_version=?" if expected is not None else "")
+        if not db.execute(sql, [*sets.values(), doc_id] + ([expected] if expected is not None else [])).rowcount:
+            return None
+    if 'summary' in data:
+        summary = pack_text(data['summary'])
+        if not db.execute("UPDATE document_contents SET main_content_summary=?, summary_status='ready' WHERE document_id=?",
+                          (summary, doc_id)).rowcount:
+            db.execute("INSERT INTO document_contents (document_id, main_content_summary) VALUES (?,?)",
+                       (doc_id, summary))
+    return doc_id
+
+@app.errorhandler(400)
+def bad_request(e):
+    if request.path.startswith('/api/'): return api_error(400, e.description)
+    return e
+
+@app.errorhandler(404)
+def not_found(e):
+    if request.path.startswith('/api/'): return api_error(404, "not found")
+    return e
+
+@app.route('/api/v1/documents')
+@api_auth()
+def api_list_documents():
+    db = get_db()
+    fields = api_fields(API_DOC_FIELDS, API_DOC_LIST_DEFAULT)
+    try: limit = min(max(int(request.args.get('limit', 50)), 1), 500)
+    except ValueError: abort(400, "limit")
+    try: join, cond, prm = filter_sql(parse_filters(request.args))
+    except ValueError as e: abort(400, str(e))
+    after = request.args.get('after')
+    key = (decode_cursor(after) or {}).get('k')
+    if after and key is None: abort(400, "after")
+    sql, kprm = keyset_page_sql(cond, prm, key, select=api_doc_select(fields, join))
+    rows = db.execute(sql, (*kprm, limit + 1)).fetchall()
+    more, rows = len(rows) > limit, rows[:limit]
+    nxt = encode_cursor({'k': [str(rows[-1]['_created']), rows[-1]['_id']]}) if more else None
+    # ETag của trang: id + row_version từng dòng, phiên bản danh bạ (tên người xử lý) và tham số
+    tag = hashlib.sha1(json.dumps([[r['_id'], r['_rv']] for r in rows] + [data_version(db, 'users'),
+                       request.query_string.decode()]).encode()).hexdigest()
+    return api_response({"data": api_doc_rows(db, rows, fields), "next": nxt}, f"docs-{tag}")
+
+@app.route('/api/v1/documents/<int:doc_id>')
+@api_auth()
+def api_get_document(doc_id):
+    item, etag = api_fetch_doc(get_db(), doc_id, api_fields(API_DOC_FIELDS, API_DOC_FIELDS))
+    return api_response(item, etag)
+
+@app.route('/api/v1/documents', methods=['POST'])
+@api_auth()
+def api_create_document():
+    db = get_db()
+    data = api_body(API_DOC_WRITABLE)
+    try: doc_id = api_write_doc(db, data)
+    except sqlite3.IntegrityError as e:
+        db.rollback(); return api_error(400, str(e))
+    db.commit()
+    item, etag = api_fetch_doc(db, doc_id, list(API_DOC_FIELDS))
+    resp = api_response(item, etag, 201)
+    resp.headers['Location'] = url_for('api_get_document', doc_id=doc_id)
+    return resp
+
+@app.route('/api/v1/documents/<int:doc_id>', methods=['PATCH'])
+@api_auth(admin=True)
+def api_update_document(doc_id):
+    db = get_db()
+    data = api_body(API_DOC_WRITABLE)
+    expected = api_if_match(doc_id)
+    if not db.execute("SELECT 1 FROM documents WHERE id=?", (doc_id,)).fetchone(): abort(404)
+    try: ok = api_write_doc(db, data, doc_id, expected)
+    except sqlite3.IntegrityError as e:
+        db.rollback(); return api_error(400, str(e))
+    if ok is None:
+        db.rollback(); return api_error(412, "tài liệu đã bị sửa bởi người khác (row_version khác If-Match)")
+    db.commit()
+    item, etag = api_fetch_doc(db, doc_id, list(API_DOC_FIELDS))
+    return api_response(item, etag)
+
+@app.route('/api/v1/users')
+@api_auth()
+def api_list_users():
+    db = get_db()
+    fields = api_fields(API_USER_FIELDS, API_USER_FIELDS)
+    users = user_directory(db)
+    data = [{k: u[k] for k in fields} for u in sorted(users['by_id'].values(), key=lambda u: u['id'])]
+    return api_response({"data": data}, f"users-{users['version']}-{_fields_tag(fields)}")
+
+@app.route('/api/v1/users/<int:user_id>')
+@api_auth()
+def api_get_user(user_id):
+    u = get_db().execute("SELECT id, username, full_name, position, role, COALESCE(avatar, '') AS avatar, row_version "
+                         "FROM users WHERE id=?", (user_id,)).fetchone()
+    if not u: abort(404)
+    fields = api_fields(API_USER_FIELDS, API_USER_FIELDS)
+    return api_response({k: u[k] for k in fields}, f"user-{u['id']}-{u['row_version']}-{_fields_tag(fields)}")
+
+@app.route('/api/v1/users', methods=['POST'])
+@api_auth(admin=True)
+def api_create_user():
+    db = get_db()
+    data = api_body(('username', 'password', 'full_name', 'position', 'role'))
+    if not data.get('username') or not data.get('password') or not data.get('full_name'):
+        abort(400, "cần username, password, full_name")
+    if data.get('role', 'user') not in ('admin', 'user'): abort(400, "role")
+    try:
+        cur = db.execute("INSERT INTO users (username, password_hash, full_name, position, role) VALUES (?,?,?,?,?)",
+                         (data['username'], generate_password_hash(data['password']), data['full_name'],
+                          data.get('position'), data.get('role', 'user')))
+    except sqlite3.IntegrityError:
+        db.rollback(); return api_error(409, f"Tên đăng nhập '{data['username']}' đã tồn tại.")
+    db.commit()
+    resp = api_get_user(cur.lastrowid)
+    resp.status_code = 201
+    resp.headers['Location'] = url_for('api_get_user', user_id=cur.lastrowid)
+    return resp
+
+@app.route('/api/v1/users/<int:user_id>', methods=['PATCH'])
+@api_auth(admin=True)
+def api_update_user(user_id):
+    db = get_db()
+    data = api_body(('password', 'full_name', 'position', 'role'))
+    if 'role' in data and data['role'] not in ('admin', 'user'): abort(400, "role")
+    if not db.execute("SELECT 1 FROM users WHERE id=?", (user_id,)).fetchone(): abort(404)
+    sets = {k: v for k, v in data.items() if k != 'password'}
+    if data.get('password'): sets['password_hash'] = generate_password_hash(data['password'])
+    expected = api_if_match(user_id)
+    assign = ", ".join([f"{k}=?" for k in sets] + ["row_version = row_version + 1"])
+    sql = f"UPDATE users SET {assign} WHERE id=?" + (" AND row_version=?" if expected is not None else "")
+    if not db.execute(sql, [*sets.values(), user_id] + ([expected] if expected is not None else [])).rowcount:
+        db.rollback(); return api_error(412, "người dùng đã bị sửa bởi người khác (row_version khác If-Match)")
+    db.commit()
+    return api_get_user(user_id)
+
+# ---------- CLI ----------
+def require_schema():
+    try: check_schema_at_startup()
+    except RuntimeError as e: raise click.ClickException(str(e))
+
+@app.cli.command('ingest-worker')
+@click.option('--processes', type=int, default=os.cpu_count() or 2, show_default=True,
+              help='Số tiến trình trích xuất song song.')
+@click.option('--once', is_flag=True, help='Xử lý hết hàng đợi rồi thoát.')
+@click.option('--poll', type=float, default=1.0, show_default=True, help='Chu kỳ kiểm tra hàng đợi (giây).')
+def ingest_worker_command(processes, once, poll):
+    """Chạy worker trích xuất văn bản/tóm tắt cho tài liệu mới tải lên."""
+    require_schema()
+    n = run_ingest_worker(get_db(), max(processes, 1), once=once, poll=poll)
+    if once: click.echo(f"Đã xử lý {n} tài liệu.")
+
+@app.cli.command('summarize')
+@click.option('--missing', is_flag=True, help='Xếp thêm các tài liệu đã trích xuất nhưng chưa có tóm tắt.')
+def summarize_command(missing):
+    """Tóm tắt các tài liệu đang chờ (theo lô, song song, dùng cache)."""
+    require_schema()
+    db = get_db()
+    if missing:
+        n = db.execute("""
+            UPDATE document_contents SET summary_status='pending', summary_attempts=0, summary_run_after=0
+            WHERE main_content_summary IS NULL AND summary_status IN ('ready', 'error')
+              AND EXISTS (SELECT 1 FROM document_pages p WHERE p.document_id = document_contents.document_id)
+        """).rowcount
+        db.commit()
+        click.echo(f"Đã xếp {n} tài liệu.")
+    click.echo(f"Đã xử lý {run_summaries(db)} tài liệu.")
+
+@app.cli.command('import-docs')
+@click.argument('directory', type=click.Path(exists=True, file_okay=False))
+@click.option('--manifest', type=click.Path(exists=True, dir_okay=False),
+              help='CSV/JSON/JSONL: original_file, translated_file, title, authoring_agency, country, creation_date, '
+                   'confidentiality_level, urgency_level, handler… Bỏ trống = mọi PDF/DOCX trong thư mục.')
+@click.option('--processes', type=int, default=os.cpu_count() or 2, show_default=True,
+              help='Số tiến trình trích xuất song song.')
+@click.option('--batch', type=int, default=200, show_default=True, help='Số tài liệu mỗi giao dịch.')
+def import_docs_command(directory, manifest, processes, batch):
+    """Nhập hàng loạt tài liệu; chạy lại cùng lệnh để tiếp tục sau khi bị ngắt."""
+    require_schema()
+    db = get_db()
+    rows = read_manifest(directory, manifest)
+    st = import_documents(db, directory, rows, max(processes, 1), max(batch, 1), echo=click.echo)
+    el = max(st['seconds'], 1e-6)
+    click.echo(f"Xong: {st['docs']} tài liệu mới ({st['skipped']} đã nhập trước đó, {st['duplicate']} trùng lặp, {st['missing']} thiếu tệp), "
+               f"{st['pages']} trang, {st['bytes'] / 1e6:.1f} MB trong {el:.1f}s — "
+               f"{st['docs'] / el:.1f} tài liệu/s, {st['bytes'] / 1e6 / el:.1f} MB/s.")
+    if st['retry']: click.echo(f"{st['retry']} tài liệu trích xuất lỗi đã được xếp cho `flask ingest-worker`.")
+    click.echo("Tóm tắt được tạo nền bởi `flask ingest-worker` hoặc `flask summarize`.")
+
+@app.cli.command('init-db')
+def init_db_command():
+    """Tạo lại các bảng từ schema.sql rồi áp dụng toàn bộ migration."""
+    db = get_db()
+    db.execute("PRAGMA foreign_keys = OFF")  # DROP TABLE users khi documents còn tham chiếu
+    with app.open_resource('schema.sql') as fh:
+        db.executescript(fh.read().decode('utf-8'))
+    db.execute(f"PRAGMA foreign_keys = {app.config['SQLITE_PRAGMAS'].get('foreign_keys', 'OFF')}")
+    db.execute("PRAGMA user_version = 0")
+    applied = upgrade_db(db)
+    click.echo(f"Đã khởi tạo CSDL (phiên bản {schema_version(db)}, {len(applied)} migration).")
+
+@app.cli.command('create-admin')
+@click.option('--username', default='admin', show_default=True)
+@click.option('--password', default='admin', show_default=True)
+@click.option('--full-name', default='Quản trị viên', show_default=True)
+def create_admin_command(username, password, full_name):
+    """Tạo tài khoản quản trị viên mặc định."""
+    db = get_db()
+    if db.execute("SELECT id FROM users WHERE username=?", (username,)).fetchone():
+        click.echo(f"Tài khoản '{username}' đã tồn tại."); return
+    db.execute("""
+        INSERT INTO users (username, password_hash, full_name, role) VALUES (?,?,?,'admin')
+    """, (username, generate_password_hash(password), full_name))
+    db.commit()
+    click.echo(f"Đã tạo tài khoản quản trị '{username}'.")
+
+@app.cli.command('gc-blobs')
+@click.option('--grace', type=int, default=3600, show_default=True,
+              help='Không xóa blob/tệp chưa dùng mới hơn số giây này (upload, import-docs đang chạy).')
+@click.option('--dry-run', is_flag=True, help='Chỉ liệt kê, không xóa.')
+def gc_blobs_command(grace, dry_run):
+    """Đếm lại tham chiếu và dọn các blob không còn tài liệu nào dùng."""
+    removed = gc_blobs(get_db(), grace=grace, dry_run=dry_run)
+    for path, _ in removed: click.echo(f"{'(dry-run) ' if dry_run else ''}xóa {path}")
+    click.echo(f"{len(removed)} tệp, {sum(size for _, size in removed) / 1e6:.1f} MB.")
+
+@app.cli.command('rebuild-avatars')
+def rebuild_avatars_command():
+    """Chuyển ảnh đại diện cũ (lưu nguyên bản) sang các cỡ nhỏ đã bỏ metadata."""
+    db = get_db()
+    done = 0
+    for u in db.execute("SELECT id, avatar FROM users WHERE avatar IS NOT NULL AND avatar <> ''").fetchall():
+        if AVATAR_RE.match(u['avatar']): continue
+        try:
+            with open(upload_abs(u['avatar']), 'rb') as fh: rel = save_avatar(fh.read())
+        except Exception as e:
+            click.echo(f"Bỏ qua người dùng {u['id']} ({u['avatar']}): {e}"); continue
+        db.execute("UPDATE users SET avatar=? WHERE id=?", (rel, u['id']))
+        db.commit()
+        release_avatar(db, u['avatar'])
+        done += 1
+    click.echo(f"Đã xử lý {done} ảnh đại diện.")
+
+@app.cli.command('compress-text')
+@click.option('--batch', type=int, default=500, show_default=True)
+def compress_text_command(batch):
+    """Nén văn bản trang/tóm tắt còn lưu nguyên văn và báo dung lượng tiết kiệm."""
+    report = compress_stored_text(get_db(), batch=batch, commit=True)
+    for table, (rows, before, after) in report.items():
+        click.echo(f"{table}: {rows} dòng, {before / 1e6:.1f} MB -> {after / 1e6:.1f} MB")
+    before, after = sum(r[1] for r in report.values()), sum(r[2] for r in report.values())
+    click.echo(f"Tiết kiệm {(before - after) / 1e6:.1f} MB. Chạy VACUUM để thu hồi dung lượng tệp.")
+
+db_cli = AppGroup('db', help='Quản lý phiên bản lược đồ CSDL.')
+
+@db_cli.command('upgrade')
+@click.option('--target', type=int, default=None, help='Dừng ở phiên bản này.')
+def db_upgrade_command(target):
+    """Áp dụng các migration còn thiếu."""
+    db = get_db()
+    before = schema_version(db)
+    applied = upgrade_db(db, target)
+    if not applied:
+        after = schema_version(db)  # có thể đã được tiến trình khác nâng cấp
+        if after >= latest_version(): click.echo(f"CSDL đã ở phiên bản mới nhất ({after}).")
+        else: click.echo(f"CSDL đang ở phiên bản {after}, không có migration nào tới phiên bản {target}.")
+        return
+    click.echo(f"Đã nâng cấp {before} -> {schema_version(db)}: migration {', '.join(map(str, applied))}.")
+
+@db_cli.command('rebuild-fts')
+def db_rebuild_fts_command():
+    """Dựng lại chỉ mục tìm kiếm toàn văn từ dữ liệu hiện có."""
+    db = get_db()
+    db.execute("INSERT INTO documents_fts(documents_fts) VALUES('rebuild')"); db.commit()
+    click.echo("Đã dựng lại chỉ mục tìm kiếm.")
+
+# các tổ hợp bộ lọc thường dùng; mỗi truy vấn danh sách/đếm phải đi qua chỉ mục
+PLAN_CHECK_FILTERS = [
+    {},
+    {'status': 'Đang xử lý'},
+    {'handler_id': '1'},
+    {'handler_id': 'null'},
+    {'country': 'Campuchia'},
+    {'year': '2025'},
+    {'year': '2025', 'week': '07'},
+    {'status': 'Chưa xử lý', 'handler_id': 'null'},
+    {'status': 'Đã xử lý', 'year': '2025', 'week': '07'},
+]
+
+def check_query_plans(db):
+    problems = []
+    for f in PLAN_CHECK_FILTERS:
+        filters = parse_filters(f)
+        join, cond, prm = filter_sql(filters)
+        where = "WHERE " + " AND ".join(cond) if cond else ""
+        list_sql, list_prm = keyset_page_sql(cond, prm, ['2100-01-01 00:00:00', 1 << 62])
+        for label, sql, params in [
+            ('count', f"SELECT COUNT(d.id) FROM documents d {join} {where}", prm),
+            ('list', list_sql, (*list_prm, 11)),
+        ]:
+            plan = [r[3] for r in db.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()]
+            bad = [p for p in plan if p == 'SCAN d' or 'TEMP B-TREE FOR ORDER BY' in p]
+            if bad: problems.append((f, label, plan))
+    return problems
+
+@db_cli.command('check-plans')
+def db_check_plans_command():
+    """Kiểm tra kế hoạch truy vấn của bộ lọc dashboard (thoát mã 1 nếu có quét toàn bảng)."""
+    problems = check_query_plans(get_db())
+    for f, label, plan in problems:
+        click.echo(f"[{label}] {f}: " + " | ".join(plan))
+    if problems: raise SystemExit(1)
+    click.echo(f"OK: {len(PLAN_CHECK_FILTERS)} tổ hợp bộ lọc đều dùng chỉ mục.")
+
+@db_cli.command('recount-stats')
+def db_recount_stats_command():
+    """Đếm lại bảng document_stats và document_facets từ documents (khi bộ đếm bị lệch)."""
+    db = get_db()
+    before = db.execute("SELECT * FROM document_stats WHERE id = 1").fetchone()
+    recount_stats(db); recount_facets(db); db.commit()
+    after = db.execute("SELECT * FROM document_stats WHERE id = 1").fetchone()
+    click.echo(f"Trước: {dict(before) if before else '—'}")
+    click.echo(f"Sau:   {dict(after)}")
+
+@db_cli.command('version')
+def db_version_command():
+    """In phiên bản lược đồ hiện tại và mới nhất."""
+    click.echo(f"Hiện tại: {schema_version(get_db())} / mới nhất: {latest_version()}")
+
+app.cli.add_command(db_cli)
+
 if __name__ == '__main__':
+    check_schema_at_startup()
     app.run(debug=True)
 
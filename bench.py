@@ -0,0 +1,296 @@
+"""Đo hiệu năng trên bộ dữ liệu giả lập, ghi kết quả JSON để so sánh giữa các lần chạy.
+
+    python bench.py --docs 100000 --users 50 --out bench-results.json
+    python bench.py --docs 100000 --compare bench-results.json   # báo các chỉ số chậm đi
+
+Mọi thứ chạy trong thư mục tạm (CSDL, uploads, cache) qua Flask test client, không đụng dữ liệu thật.
+"""
+import io
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import click
+import docx
+import fitz  # PyMuPDF
+
+import app as A
+
+COUNTRIES = ['Lào', 'Campuchia', 'Thái Lan', 'Trung Quốc', 'Hoa Kỳ', 'Nhật Bản', 'Hàn Quốc', 'Nga', 'Ấn Độ', 'Úc']
+STATUSES = ['Chưa xử lý', 'Đang xử lý', 'Đã xử lý']
+WORDS = ('báo cáo kinh tế hợp tác an ninh quốc phòng thương mại đầu tư năng lượng giao thông biên giới '
+         'khoa học công nghệ trí tuệ nhân tạo y tế giáo dục nông nghiệp ngoại giao môi trường tài chính '
+         'ngân hàng du lịch văn hóa lao động viễn thông hàng hải').split()
+AGENCIES = ['Bộ Ngoại giao', 'Bộ Công Thương', 'Bộ Quốc phòng', 'Bộ Kế hoạch và Đầu tư', 'Ngân hàng Nhà nước']
+PAGE_COUNTS = (1, 10, 50)        # số trang của tệp PDF/DOCX mẫu
+FILTERS = {                      # tổ hợp bộ lọc của trang Tài liệu
+    'all': {},
+    'q_word': {'q': 'kinh tế'},
+    'q_prefix': {'q': 'hợp t'},
+    'country': {'country': 'Lào'},
+    'status': {'status': 'Đang xử lý'},
+    'year_week': {'year': '2024', 'week': '10'},
+    'handler': {'handler_id': '1'},
+    'unassigned': {'handler_id': 'null'},
+    'combined': {'country': 'Campuchia', 'status': 'Đang xử lý', 'year': '2024'},
+}
+DEPTHS = (1, 10, 50)             # trang thứ mấy (đi theo con trỏ "sau")
+
+
+def sentence(rnd, n):
+    return " ".join(rnd.choice(WORDS) for _ in range(n))
+
+def timed(fn, repeat):
+    out = []
+    for _ in range(repeat):
+        t = time.perf_counter(); fn(); out.append(time.perf_counter() - t)
+    return out
+
+def summary_ms(samples):
+    s = sorted(samples)
+    return {'n': len(s), 'min_ms': round(s[0] * 1000, 3), 'p50_ms': round(statistics.median(s) * 1000, 3),
+            'p95_ms': round(s[min(len(s) - 1, int(len(s) * 0.95))] * 1000, 3),
+            'mean_ms': round(statistics.fmean(s) * 1000, 3)}
+
+def make_pdf(rnd, pages):
+    pdf = fitz.open()
+    for _ in range(pages):
+        pg = pdf.new_page()
+        pg.insert_textbox(fitz.Rect(50, 50, 550, 800), "\n".join(sentence(rnd, 14) for _ in range(40)),
+                          fontname='helv', fontsize=10)
+    return pdf.tobytes()
+
+def make_docx(rnd, pages):
+    d = docx.Document()
+    for i in range(pages):
+        d.add_heading(sentence(rnd, 5), 1)
+        for _ in range(12): d.add_paragraph(sentence(rnd, 40))
+        if i % 5 == 0:
+            t = d.add_table(rows=4, cols=3)
+            for cell in t._cells: cell.text = sentence(rnd, 3)
+    bio = io.BytesIO(); d.save(bio)
+    return bio.getvalue()
+
+# ---------- dữ liệu giả lập ----------
+def setup_app(workdir):
+    A.app.config.update(
+        TESTING=True, INGEST_ASYNC=False,
+        DATABASE=os.path.join(workdir, 'bench.db'), UPLOAD_FOLDER=os.path.join(workdir, 'uploads'),
+        RENDER_CACHE_DIR=os.path.join(workdir, 'render_cache'), PREVIEW_CACHE_DIR=os.path.join(workdir, 'preview_cache'),
+        METRICS_DIR=os.path.join(workdir, 'metrics'), VIEW_CACHE_PATH=os.path.join(workdir, 'view_cache.db'),
+        # đo mặc định khi cache nguội: mỗi mẫu phải chạy truy vấn thật (bench_dashboard(warm=True) đo riêng khi cache nóng)
+        VIEW_CACHE=None, LIST_COUNT_TTL=0,
+    )
+    os.makedirs(A.app.config['UPLOAD_FOLDER'], exist_ok=True)
+    r = A.app.test_cli_runner().invoke(args=['init-db'])
+    if r.exit_code: raise click.ClickException(r.output)
+
+def generate_corpus(rnd, n_users, n_docs, batch=5000):
+    db = sqlite3.connect(A.app.config['DATABASE'], isolation_level=None)
+    A.register_sql_functions(db)  # view nguồn FTS gọi unz()
+    db.execute("PRAGMA journal_mode=WAL"); db.execute("PRAGMA synchronous=OFF")
+    pw = A.generate_password_hash('bench')
+    db.execute("BEGIN")
+    db.execute("INSERT INTO users (username, password_hash, full_name, role) VALUES ('admin', ?, 'Quản trị viên', 'admin')", (pw,))
+    db.executemany("INSERT INTO users (username, password_hash, full_name, position, role) VALUES (?,?,?,?, 'user')",
+                   [(f'bench{i}', pw, f'Cán bộ {i:04d}', 'Chuyên viên') for i in range(1, n_users)])
+    db.execute("COMMIT")
+    start = datetime(2020, 1, 1)
+    span = int((datetime(2025, 12, 31) - start).total_seconds())
+    stamps = sorted(rnd.randrange(span) for _ in range(n_docs))
+    done = 0
+    while done < n_docs:
+        docs, contents = [], []
+        for i in range(done, min(done + batch, n_docs)):
+            handler = rnd.randint(1, n_users) if rnd.random() < 0.7 else None
+            status = rnd.choice(STATUSES[1:]) if handler else STATUSES[0]
+            created = start + timedelta(seconds=stamps[i])
+            made = created - timedelta(days=rnd.randint(0, 60))
+            docs.append((i + 1, sentence(rnd, 8).capitalize(), rnd.choice(AGENCIES), rnd.choice(COUNTRIES),
+                         made.strftime('%Y-%m-%d'), rnd.choice(['Mở', 'Mật']), rnd.choice(['Thường', 'Mật', 'Tối mật']),
+                         rnd.choice(['Thường', 'Khẩn', 'Hỏa tốc']), handler, status, sentence(rnd, 6),
+                         created.strftime('%Y-%m-%d %H:%M:%S')))
+            contents.append((i + 1, sentence(rnd, 60)))
+        db.execute("BEGIN")
+        db.executemany("""
+            INSERT INTO documents (id, title, authoring_agency, country, creation_date, source_type,
+                confidentiality_level, urgency_level, handler_id, status, notes, created_at, ingest_status)
+            VALUES (?,?,?,?,?,?,?,?,?,?,?,?,'ready')
+        """, docs)
+        db.executemany("INSERT INTO document_contents (document_id, main_content_summary, summary_status) VALUES (?,?,'ready')",
+                       contents)
+        db.execute("COMMIT")
+        done += len(docs)
+    db.execute("ANALYZE"); db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    db.close()
+
+def write_samples(rnd, workdir):
+    samples = {}
+    for n in PAGE_COUNTS:
+        for ext, make in (('pdf', make_pdf), ('docx', make_docx)):
+            p = os.path.join(workdir, f'sample_{n}p.{ext}')
+            with open(p, 'wb') as fh: fh.write(make(rnd, n))
+            samples[f'{ext}_{n}p'] = p
+    return samples
+
+def login(client):
+    r = client.post('/login', data={'username': 'admin', 'password': 'bench'})
+    if r.status_code != 302: raise click.ClickException("đăng nhập thất bại")
+
+# ---------- các phép đo ----------
+def bench_dashboard(client, repeat, warm=False):
+    out = {}
+    if warm: A.app.config.update(VIEW_CACHE='memory', LIST_COUNT_TTL=30)
+    try:
+        _bench_dashboard(client, repeat, warm, out)
+    finally:
+        A.app.config.update(VIEW_CACHE=None, LIST_COUNT_TTL=0); A._count_cache.clear()
+    return out
+
+def _bench_dashboard(client, repeat, warm, out):
+    for name, params in FILTERS.items():
+        for depth in DEPTHS:
+            # đi theo con trỏ tới trang cần đo, chỉ tính thời gian của trang đó
+            args, ok = dict(params, page_size=20), True
+            for page in range(1, depth):
+                r = client.get('/', query_string=args)
+                cursor = _next_cursor(r.get_data(as_text=True))
+                if not cursor: ok = False; break
+                args.update(after=cursor, page=page + 1)
+            if not ok: continue
+
+            def hit():
+                r = client.get('/', query_string=args)
+                assert r.status_code == 200, r.status_code
+            if warm: hit()  # lần đầu nạp cache, chỉ đo các lần trúng
+            out[f'{name}@p{depth}'] = summary_ms(timed(hit, repeat))
+
+def _next_cursor(html):
+    # liên kết "trang sau" trong index.html mang ?after=<con trỏ>
+    m = re.search(r'[?&;]after=([\w-]+)', html)
+    return m and m.group(1)
+
+def bench_add_document(client, rnd, samples, count):
+    out = {}
+    pdf = open(samples['pdf_1p'], 'rb').read()
+    for name, with_file in (('metadata_only', False), ('with_pdf_1p', True)):
+        def add():
+            data = {'title': sentence(rnd, 8), 'authoring_agency': rnd.choice(AGENCIES), 'country': rnd.choice(COUNTRIES),
+                    'creation_date': '2025-05-05', 'source_type': 'Mở', 'confidentiality_level': 'Thường',
+                    'urgency_level': 'Thường', 'handler_id': '1', 'notes': sentence(rnd, 6)}
+            if with_file:
+                # nội dung khác nhau để không trùng blob (đo cả lưu tệp lẫn trích xuất)
+                data['original_file'] = (io.BytesIO(pdf + os.urandom(16)), 'bench.pdf')
+            r = client.post('/documents/add', data=data, content_type='multipart/form-data')
+            assert r.status_code == 302, r.status_code
+        samples_s = timed(add, count)
+        out[name] = dict(summary_ms(samples_s), docs_per_s=round(count / sum(samples_s), 2))
+    return out
+
+def bench_extract(samples, repeat):
+    out = {}
+    for name, p in samples.items():
+        mb = os.path.getsize(p) / (1 << 20)
+        s = timed(lambda: A.read_text_from_file(p), repeat)
+        out[name] = dict(summary_ms(s), size_mb=round(mb, 3), mb_per_s=round(mb / statistics.median(s), 2))
+    return out
+
+def bench_serve_upload(client, samples, repeat):
+    out = {}
+    for name in ('pdf_1p', 'pdf_50p', 'docx_50p'):
+        with A.app.app_context():
+            rel = A.store_blob(A.get_db(), open(samples[name], 'rb'), os.path.basename(samples[name]))
+            A.get_db().commit()
+        url = '/uploads/' + rel
+        size = os.path.getsize(samples[name]) / (1 << 20)
+        s = timed(lambda: client.get(url).close(), repeat)
+        etag = client.get(url).headers['ETag']
+        cond = timed(lambda: client.get(url, headers={'If-None-Match': etag}).close(), repeat)
+        out[name] = dict(summary_ms(s), size_mb=round(size, 3), mb_per_s=round(size / statistics.median(s), 2),
+                         req_per_s=round(1 / statistics.median(s), 1), not_modified=summary_ms(cond))
+    return out
+
+# ---------- so sánh ----------
+def flatten(d, prefix=''):
+    for k, v in d.items():
+        if isinstance(v, dict): yield from flatten(v, f'{prefix}{k}.')
+        else: yield f'{prefix}{k}', v
+
+def compare(old, new, threshold):
+    # chỉ số *_ms tăng hoặc *_per_s giảm quá ngưỡng được coi là chậm đi
+    prev = dict(flatten(old['results'])); worse = []
+    for k, v in flatten(new['results']):
+        base = prev.get(k)
+        if not isinstance(v, (int, float)) or not base: continue
+        if k.endswith('p50_ms') and v > base * (1 + threshold): worse.append((k, base, v))
+        elif k.endswith('_per_s') and v < base * (1 - threshold): worse.append((k, base, v))
+    return worse
+
+def git_rev():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+@click.command()
+@click.option('--docs', default=10000, show_default=True, help='Số tài liệu giả lập (10k–1M).')
+@click.option('--users', default=20, show_default=True, help='Số người dùng.')
+@click.option('--repeat', default=20, show_default=True, help='Số lần lặp mỗi phép đo.')
+@click.option('--adds', default=50, show_default=True, help='Số tài liệu thêm khi đo add_document.')
+@click.option('--seed', default=1, show_default=True)
+@click.option('--out', 'out_path', default='bench-results.json', show_default=True, type=click.Path())
+@click.option('--compare', 'baseline', type=click.Path(exists=True), help='Tệp kết quả cũ để so sánh.')
+@click.option('--threshold', default=0.2, show_default=True, help='Tỷ lệ chậm đi được báo (0.2 = 20%).')
+@click.option('--keep', is_flag=True, help='Giữ lại thư mục tạm.')
+def main(docs, users, repeat, adds, seed, out_path, baseline, threshold, keep):
+    """Sinh bộ dữ liệu giả lập rồi đo trang Tài liệu, thêm tài liệu, trích xuất văn bản và tải tệp."""
+    rnd = random.Random(seed)
+    workdir = tempfile.mkdtemp(prefix='qltl-bench-')
+    try:
+        t = time.perf_counter()
+        setup_app(workdir)
+        generate_corpus(rnd, max(users, 1), docs)
+        samples = write_samples(rnd, workdir)
+        click.echo(f"Đã sinh {docs} tài liệu, {users} người dùng trong {time.perf_counter() - t:.1f}s ({workdir})")
+        client = A.app.test_client(); login(client)
+        results = {}
+        for name, fn in (('dashboard', lambda: bench_dashboard(client, repeat)),
+                         ('dashboard_warm', lambda: bench_dashboard(client, repeat, warm=True)),
+                         ('extract', lambda: bench_extract(samples, max(repeat // 4, 3))),
+                         ('serve_upload', lambda: bench_serve_upload(client, samples, repeat)),
+                         ('add_document', lambda: bench_add_document(client, rnd, samples, adds))):
+            t = time.perf_counter(); results[name] = fn()
+            click.echo(f"  {name}: {time.perf_counter() - t:.1f}s")
+        report = {
+            'meta': {'timestamp': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'), 'git': git_rev(),
+                     'python': platform.python_version(), 'sqlite': sqlite3.sqlite_version,
+                     'platform': platform.platform(), 'params': {'docs': docs, 'users': users, 'repeat': repeat,
+                                                                  'adds': adds, 'seed': seed}},
+            'results': results,
+        }
+        with open(out_path, 'w', encoding='utf-8') as fh: json.dump(report, fh, ensure_ascii=False, indent=2)
+        click.echo(f"Đã ghi {out_path}")
+        if baseline:
+            with open(baseline, encoding='utf-8') as fh: old = json.load(fh)
+            if old['meta']['params'] != report['meta']['params']:
+                click.echo("Cảnh báo: tham số khác lần chạy gốc, kết quả có thể không so sánh được.")
+            worse = compare(old, report, threshold)
+            for k, a, b in worse: click.echo(f"  CHẬM HƠN {k}: {a} -> {b}")
+            if worse: sys.exit(1)
+            click.echo("Không có chỉ số nào chậm đi quá ngưỡng.")
+    finally:
+        if not keep: shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,17 @@
 -- Xóa các bảng nếu chúng đã tồn tại để dễ dàng khởi tạo lại
 DROP TABLE IF EXISTS users;
 DROP TABLE IF EXISTS documents;
+DROP TABLE IF EXISTS documents_fts;
+DROP TABLE IF EXISTS document_contents;
+DROP TABLE IF EXISTS document_stats;
+DROP TABLE IF EXISTS document_facets;
+DROP TABLE IF EXISTS ingest_jobs;
+DROP TABLE IF EXISTS document_pages;
+DROP TABLE IF EXISTS blobs;
+DROP TABLE IF EXISTS summary_cache;
+DROP TABLE IF EXISTS data_versions;
+DROP TABLE IF EXISTS import_log;
+DROP VIEW IF EXISTS documents_fts_src;
 
 -- Bảng người dùng
 CREATE TABLE users (